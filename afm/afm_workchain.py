@@ -71,7 +71,8 @@ class AfmWorkChain(WorkChain):
         afm_pp_inputs['code'] = self.inputs.afm_pp_code
         afm_pp_inputs['parameters'] = self.inputs.afm_pp_params
         afm_pp_inputs['parent_calc_folder'] = self.ctx.scf_diag.outputs.remote_folder
-        afm_pp_inputs['atomtypes'] = SinglefileData(file="/home/aiida/apps/scanning_probe/afm/atomtypes_pp.ini")
+        afm_pp_inputs['atomtypes'] = common.get_or_store_node(
+            SinglefileData(file="/home/aiida/apps/scanning_probe/afm/atomtypes_pp.ini"))
         afm_pp_inputs['metadata']['options'] = {
             "resources": {"num_machines": 1},
             "max_wallclock_seconds": 7200,
@@ -88,7 +89,8 @@ class AfmWorkChain(WorkChain):
         afm_2pp_inputs['code'] = self.inputs.afm_2pp_code
         afm_2pp_inputs['parameters'] = self.inputs.afm_2pp_params
         afm_2pp_inputs['parent_calc_folder'] = self.ctx.scf_diag.outputs.remote_folder
-        afm_2pp_inputs['atomtypes'] = SinglefileData(file="/home/aiida/apps/scanning_probe/afm/atomtypes_2pp.ini")
+        afm_2pp_inputs['atomtypes'] = common.get_or_store_node(
+            SinglefileData(file="/home/aiida/apps/scanning_probe/afm/atomtypes_2pp.ini"))
         afm_2pp_inputs['metadata']['options'] = {
             "resources": {"num_machines": 1},
             "max_wallclock_seconds": 7200,
@@ -118,7 +120,7 @@ class AfmWorkChain(WorkChain):
         tmpdir = tempfile.mkdtemp()
         geom_fn = tmpdir + '/geom.xyz'
         atoms.write(geom_fn)
-        geom_f = SinglefileData(file=geom_fn)
+        geom_f = common.get_or_store_node(SinglefileData(file=geom_fn))
         shutil.rmtree(tmpdir)
 
         inputs['file']['geom_coords'] = geom_f
@@ -2,24 +2,65 @@ import numpy as np
 from numpy.linalg import norm
 from ase import Atoms
 from ase.data import covalent_radii
-from ase.neighborlist import NeighborList
 import ase.neighborlist
 import scipy.stats
+import scipy.signal
+import scipy.sparse
+import scipy.sparse.csgraph
 from scipy.constants import physical_constants
 import itertools
+import copy
 from IPython.display import display, clear_output, HTML
 import nglview
 import ipywidgets as ipw
-from collections import Counter
+from collections import Counter, OrderedDict
 from scipy.signal import find_peaks
-from scipy.spatial import ConvexHull
+from scipy.spatial import ConvexHull, cKDTree
     
 def gaussian(x, sig):
     return 1.0/(sig*np.sqrt(2.0*np.pi))*np.exp(-np.power(x, 2.) / (2 * np.power(sig, 2.)))
 
 def boxfilter(x,thr):
     return np.asarray([1 if i<thr else 0 for i in x])
-def get_types(frame,thr): ## Piero Gasparotto
+def atomic_density_z(atoms_z_pos, z_values, sigma, kernel_width=10.0, noise_level=1e-9):
+    """
+    Sum of gaussians centered at the atomic z positions, sampled on the
+    equidistant z_values: z positions are binned onto the grid with linear
+    (cloud-in-cell) weights and convolved with the gaussian by FFT.
+    Values below noise_level*max (FFT round-off) are set to zero, so that
+    they don't show up as peaks.
+    """
+    dz = z_values[1] - z_values[0]
+    n_z = len(z_values)
+    t = (atoms_z_pos - z_values[0]) / dz
+    i_low = np.clip(np.floor(t).astype(int), 0, n_z - 2)
+    w_high = t - i_low
+    hist = (np.bincount(i_low, weights=1.0 - w_high, minlength=n_z)
+            + np.bincount(i_low + 1, weights=w_high, minlength=n_z))
+    n_kernel = int(np.ceil(kernel_width * sigma / dz))
+    kernel = gaussian(np.arange(-n_kernel, n_kernel + 1) * dz, sigma)
+    density = scipy.signal.fftconvolve(hist, kernel, mode='same')
+    density[density < noise_level * np.max(density)] = 0.0
+    return density
+
+def refine_density_peaks(density, z_values, atoms_z_pos, sigma, window=3, cutoff=10.0):
+    """
+    Replaces the density around its peaks by the exact sum of gaussians
+    (only atoms within cutoff*sigma contribute) and returns the peaks of the result
+    """
+    peaks = find_peaks(density)[0]
+    if len(peaks) == 0:
+        return peaks
+    refine = np.unique((peaks[:, None] + np.arange(-window, window + 1)).ravel())
+    refine = refine[(refine >= 0) & (refine < len(z_values))]
+    sorted_z = np.sort(atoms_z_pos)
+    density = density.copy()
+    for i_z in refine:
+        i0, i1 = np.searchsorted(sorted_z, [z_values[i_z] - cutoff*sigma, z_values[i_z] + cutoff*sigma])
+        density[i_z] = np.sum(gaussian(z_values[i_z] - sorted_z[i0:i1], sigma))
+    return find_peaks(density)[0]
+
+def get_types(frame,thr,neighbors=None): ## Piero Gasparotto
     # classify the atmos in:
     # 0=molecule
     # 1=slab atoms
@@ -29,7 +70,8 @@ def get_types(frame,thr): ## Piero Gasparotto
     # 6=metalating atoms
     #frame=ase frame
     #thr=threashold in the histogram for being considered a surface layer
-    nat=frame.get_number_of_atoms()
+    #neighbors=CovalentNeighbors of the frame, built if not given
+    nat=len(frame)
     atype=np.zeros(nat,dtype=np.int16)+5
     area=(frame.cell[0][0]*frame.cell[1][1])
     minz=np.min(frame.positions[:,2])
@@ -41,169 +83,176 @@ def get_types(frame,thr): ## Piero Gasparotto
     
     ##WHICH VALUES SHOULD WE USE BELOW??????
     sigma = 0.2 #thr
-    peak_rel_height = 0.5
     layer_tol=1.0*sigma 
     # quack estimate number atoms in a layer:
     nbins=int(np.ceil((maxz-minz)/0.15))
     hist, bin_edges = np.histogram(frame.positions[:,2], density=False,bins=nbins)
     max_atoms_in_a_layer=max(hist)
     
-    lbls=frame.get_chemical_symbols()
+    lbls=np.array(frame.get_chemical_symbols())
     n_intervals=int(np.ceil((maxz-minz+3*sigma)/(0.1*sigma)))
     z_values = np.linspace(minz-3*sigma, maxz+3*sigma, n_intervals) #1000
     atoms_z_pos = frame.positions[:,2]
     
-    # OPTION 1: generate 2d array to apply the gaussian on
-    z_v_exp, at_z_exp = np.meshgrid(z_values, atoms_z_pos)
-    arr_2d = z_v_exp - at_z_exp
-    atomic_density = np.sum(gaussian(arr_2d, sigma), axis=0)
-    
-    # OPTION 2: loop through atoms
-    # atomic_density = np.zeros(z_values.shape)
-    #for ia in range(len(atoms)):
-    #    atomic_density += gaussian(z_values - atoms.positions[ia,2], sigma) 
-
-    peaks=find_peaks(atomic_density, height=None,threshold=None,distance=None,
-                     prominence=None,width=None,wlen=None,rel_height=peak_rel_height)
-    layersg=z_values[peaks[0].tolist()]
+    # density by FFT on the z grid, exact values around the peaks
+    atomic_density = atomic_density_z(atoms_z_pos, z_values, sigma)
+    peaks = refine_density_peaks(atomic_density, z_values, atoms_z_pos, sigma)
+    layersg=z_values[peaks]
     n_tot_layers=len(layersg)
     last_layer=layersg[-1]
 
     ##check top and bottom layers
     
-    found_top_surf = False
-    while not found_top_surf:
-        iz = layersg[-1]
-        twoD_atoms = [frame.positions[i,0:2] for i in range(nat) if np.abs(frame.positions[i,2]-iz) <layer_tol ]
+    def layer_coverage(iz):
+        twoD_atoms = frame.positions[np.abs(atoms_z_pos-iz) <layer_tol, 0:2]
         coverage=0
         if len(twoD_atoms) > max_atoms_in_a_layer/4:
             hull = ConvexHull(twoD_atoms) ##  
             coverage = hull.volume/area
-        if coverage > 0.3:
-            found_top_surf=True
-        else:
-            layersg=layersg[0:-1]
+        return coverage
+    
+    while layer_coverage(layersg[-1]) <= 0.3:
+        layersg=layersg[0:-1]
                     
-    found_bottom_surf = False
-    while not found_bottom_surf:
-        iz = layersg[0]
-        twoD_atoms = [frame.positions[i,0:2] for i in range(nat) if np.abs(frame.positions[i,2]-iz) <layer_tol]
-        coverage=0
-        if len(twoD_atoms) > max_atoms_in_a_layer/4:        
-            hull = ConvexHull(twoD_atoms) ## 
-            coverage = hull.volume/area
-        if coverage > 0.3 and len(twoD_atoms) > max_atoms_in_a_layer/4 :
-            found_bottom_surf=True
-        else:
-            layersg=layersg[1:]   
+    while layer_coverage(layersg[0]) <= 0.3:
+        layersg=layersg[1:]   
     
     bottom_z = layersg[0]
     top_z = layersg[-1]
     
     #check if there is a bottom layer of H
-    found_layer_of_H=True
-    for i in range(nat):
-        iz = frame.positions[i,2]
-        if iz > bottom_z - layer_tol and iz < bottom_z + layer_tol:
-            if lbls[i]=='H':
-                atype[i]=3
-            else:
-                found_layer_of_H=False
-                break
+    # (the H atoms before the first non-H atom of the bottom layer are marked anyway)
+    in_bottom = np.where((atoms_z_pos > bottom_z - layer_tol) & (atoms_z_pos < bottom_z + layer_tol))[0]
+    not_h = np.where(lbls[in_bottom] != 'H')[0]
+    found_layer_of_H = len(not_h) == 0
+    atype[in_bottom[:not_h[0] if len(not_h) > 0 else len(in_bottom)]] = 3
     if found_layer_of_H:
         layersg=layersg[1:]
         #bottom_z=layersg[0]
         
-    layers_dist = []
-    iprev = layersg[0]
-    for inext in layersg[1:]:
-        layers_dist.append(abs(iprev - inext))
-        iprev = inext 
+    layers_dist = np.abs(np.diff(layersg))
     
-    for i in range(nat):
-        iz = frame.positions[i,2]
-        if iz > bottom_z - layer_tol and iz < top_z + layer_tol:
-            if not (atype[i]==3 and found_layer_of_H):
-                atype[i]=1
-        else:
-            if np.min([np.abs(iz- top_z),np.abs(iz- bottom_z)]) < np.max(layers_dist):   
-                if not (atype[i]==3 and found_layer_of_H): 
-                    atype[i]=2
+    keep = (atype==3) & found_layer_of_H
+    in_slab = (atoms_z_pos > bottom_z - layer_tol) & (atoms_z_pos < top_z + layer_tol)
+    atype[in_slab & ~keep] = 1
+    outside = ~in_slab & ~keep
+    if np.any(~in_slab):
+        dist_to_surf = np.minimum(np.abs(atoms_z_pos - top_z), np.abs(atoms_z_pos - bottom_z))
+        atype[outside & (dist_to_surf < np.max(layers_dist))] = 2
     
     # assign the other types
     metalatingtypes=('Au','Ag','Cu','Ni','Co','Zn','Mg')
     moltypes=('H','N','B','O','C','F','S','Br','I','Cl')
-    possible_mol_atoms=[i for i in range(nat) if atype[i]==2 and lbls[i] in moltypes]
-    possible_mol_atoms+=[i for i in range(nat) if atype[i]==5]
+    possible_mol_atoms=np.where((atype==2) & np.isin(lbls, moltypes))[0].tolist()
+    possible_mol_atoms+=np.where(atype==5)[0].tolist()
     
     if len(possible_mol_atoms) > 0:
-        cov_radii = [covalent_radii[a.number] for a in frame[possible_mol_atoms]]  #adatoms that have a neigh adatom are in a mol
-        nl = NeighborList(cov_radii, bothways = True, self_interaction = False)
-        nl.update(frame[possible_mol_atoms])
-        for ia in range(len(possible_mol_atoms)):
-            indices, offsets = nl.get_neighbors(ia)
-
-            if len(indices) > 0:
-                if lbls[possible_mol_atoms[ia]] in metalatingtypes:
-                    atype[possible_mol_atoms[ia]]=6
-                else:
-                    atype[possible_mol_atoms[ia]]=0
+        #adatoms that have a neigh adatom are in a mol
+        if neighbors is None:
+            neighbors = CovalentNeighbors(frame)
+        bonded = np.unique(neighbors.bonds(possible_mol_atoms)[0])
+        metalating = np.isin(lbls[bonded], metalatingtypes)
+        atype[bonded[metalating]]=6
+        atype[bonded[~metalating]]=0
     return atype,layersg
 
-def all_connected_to(id_atom,atoms,exclude):
-    cov_radii = [covalent_radii[a.number] for a in atoms]
-    
-    atoms.set_pbc([False, False, False])
-    nl_no_pbc = NeighborList(cov_radii, bothways = True, self_interaction = False)
-    nl_no_pbc.update(atoms)
-    atoms.set_pbc([True,True,True])
+class CovalentNeighbors(object):
+    """
+    Covalent bonds of all atoms, shared by the steps of analyze():
+    i and j are bonded if closer than r_i + r_j + 2*skin (as ase NeighborList).
+    The bonds are found with a periodic cKDTree, for non-orthorhombic cells
+    or cutoffs too long for the minimum image convention ase is used.
+    """
+
+    def __init__(self, atoms, skin=0.3):
+        self.atoms = atoms
+        self.cutoffs = covalent_radii[atoms.numbers] + skin
+        self._bonds = None
+
+    def _orthorhombic_ok(self):
+        cell = np.asarray(self.atoms.cell)
+        lengths = np.diag(cell)
+        if not np.allclose(cell, np.diag(lengths)):
+            return False
+        pbc = self.atoms.pbc
+        return np.all(2*np.max(self.cutoffs) < lengths[pbc]/2)
+
+    def _kdtree_bonds(self):
+        pos = self.atoms.positions
+        max_pair_cut = 2*np.max(self.cutoffs)
+        lengths = np.diag(np.asarray(self.atoms.cell))
+        pbc = self.atoms.pbc
+        # non-periodic directions get a box large enough to never wrap
+        box = np.where(pbc, lengths, np.ptp(pos, axis=0) + 2*max_pair_cut + 1.0)
+        wrapped = np.where(pbc, pos, pos - np.min(pos, axis=0))
+        wrapped = np.mod(wrapped, box)
+        wrapped[wrapped >= box] = 0.0
+        
+        tree = cKDTree(wrapped, boxsize=box)
+        pairs = tree.query_pairs(max_pair_cut, output_type='ndarray')
+        i, j = pairs[:, 0], pairs[:, 1]
+        cut = self.cutoffs[i] + self.cutoffs[j]
+        delta = wrapped[j] - wrapped[i]
+        delta -= box*np.round(delta/box)
+        bonded = norm(delta, axis=1) < cut
+        i, j, cut = i[bonded], j[bonded], cut[bonded]
+        crossing = norm(pos[j] - pos[i], axis=1) >= cut
+        return (np.concatenate([i, j]), np.concatenate([j, i]),
+                np.concatenate([crossing, crossing]))
+
+    def _ase_bonds(self):
+        i, j, shifts = ase.neighborlist.neighbor_list('ijS', self.atoms, self.cutoffs,
+                                                      self_interaction=False)
+        return i, j, np.any(shifts != 0, axis=1)
+
+    def bonds(self, subset=None, pbc=True):
+        """
+        Bonds (i, j), both ways, between the atoms in subset (all by default).
+        With pbc=False bonds to periodic images are left out.
+        """
+        if self._bonds is None:
+            if len(self.atoms) < 2:
+                self._bonds = (np.zeros(0, dtype=int),)*2 + (np.zeros(0, dtype=bool),)
+            elif self._orthorhombic_ok():
+                self._bonds = self._kdtree_bonds()
+            else:
+                self._bonds = self._ase_bonds()
+        i, j, crossing = self._bonds
+        keep = np.ones(len(i), dtype=bool) if pbc else ~crossing
+        if subset is not None:
+            in_subset = np.zeros(len(self.atoms), dtype=bool)
+            in_subset[subset] = True
+            keep &= in_subset[i] & in_subset[j]
+        return i[keep], j[keep]
+
+    def connectivity_matrix(self, subset, pbc=True):
+        """Sparse bond matrix between the atoms in subset, in the order of subset"""
+        subset = np.asarray(subset)
+        local = np.zeros(len(self.atoms), dtype=int)
+        local[subset] = np.arange(len(subset))
+        i, j = self.bonds(subset, pbc)
+        return scipy.sparse.coo_matrix((np.ones(len(i), dtype=bool), (local[i], local[j])),
+                                       shape=(len(subset), len(subset))).tocsr()
+
+def molecules(ismol,atoms,neighbors=None):
+    """
+    Groups the atoms ismol into molecules (connected components of the bond graph
+    without periodic images), ordered by their lowest index in ismol,
+    each sorted by atom index
+    """
+    if len(ismol) == 0:
+        return []
+    if neighbors is None:
+        neighbors = CovalentNeighbors(atoms)
+    ismol = np.asarray(ismol)
+    n_mols, labels = scipy.sparse.csgraph.connected_components(
+        neighbors.connectivity_matrix(ismol, pbc=False), directed=False)
     
-    tofollow=[]
-    followed=[]
-    isconnected=[]
-    tofollow.append(id_atom)
-    isconnected.append(id_atom)
-    while len(tofollow) > 0:
-        indices, offsets = nl_no_pbc.get_neighbors(tofollow[0])
-        indices=list(indices)
-        followed.append(tofollow[0])
-        for i in indices:
-            if (i not in isconnected) and (atoms[i].symbol not in exclude):
-                tofollow.append(i)
-                isconnected.append(i)
-        for i in followed:
-            if i in tofollow: ### do not remove this check
-                tofollow.remove(i)
-            #try:
-            #    tofollow.remove(i)
-            #except:
-            #    pass
-            #    
-            
-
-    return isconnected
-
-def molecules(ismol,atoms):
-    all_molecules=[]
-    to_be_checked=[i for i in range(len(ismol))]
-    all_found=[]
-    exclude=['None']
-    while len(to_be_checked) >0:
-        one_mol=all_connected_to(to_be_checked[0],atoms[ismol],exclude)
-
-        is_new_molecule = True
-        for ia in one_mol:
-            if ia in all_found:
-                is_new_molecule=False
-                break
-                
-        if is_new_molecule:
-            all_molecules.append([ismol[ia] for ia in one_mol])
-            for ia in one_mol:
-                all_found.append(ia)
-                to_be_checked.remove(ia)
-                
-            
+    # group the local indices by molecule, ascending within each molecule
+    order = np.argsort(labels, kind='stable')
+    groups = np.split(order, np.cumsum(np.bincount(labels, minlength=n_mols))[:-1])
+    groups.sort(key=lambda inds: inds[0])
+    all_molecules = [np.sort(ismol[inds]).tolist() for inds in groups]
     return all_molecules
 
 def to_ranges(iterable):
@@ -233,7 +282,8 @@ def string_range_to_list(a):
         singles+=to_add
     return sorted(singles)
 
-def analyze(atoms):
+def prepare_cell(atoms):
+    """Sets the bounding box (+10 ang) as cell if there is none and makes the atoms periodic"""
     no_cell=atoms.cell[0][0] <0.1 or atoms.cell[1][1] <0.1 or atoms.cell[2][2] <0.1 
     if no_cell:
         # set bounding box as cell
@@ -244,6 +294,9 @@ def analyze(atoms):
     
     atoms.set_pbc([True,True,True])
 
+def analyze(atoms):
+    prepare_cell(atoms)
+
     total_charge=np.sum(atoms.get_atomic_numbers())
     bottom_H=[]
     adatoms=[]
@@ -265,10 +318,8 @@ def analyze(atoms):
     vacuum_y=np.max(atoms.positions[:,1]) - np.min(atoms.positions[:,1]) +4 < atoms.cell[1][1]
     vacuum_z=np.max(atoms.positions[:,2]) - np.min(atoms.positions[:,2]) +4 < atoms.cell[2][2]
     all_elements= atoms.get_chemical_symbols() # list(set(atoms.get_chemical_symbols()))
-    cov_radii = [covalent_radii[a.number] for a in atoms]
-    
-    nl = NeighborList(cov_radii, bothways = True, self_interaction = False)
-    nl.update(atoms)
+    # bonds are found once (when first needed) for slab typing and molecules
+    neighbors = CovalentNeighbors(atoms)
     
     #metalating_atoms=['Ag','Au','Cu','Co','Ni','Fe']
     
@@ -283,7 +334,7 @@ def analyze(atoms):
         is_a_molecule=True
         sys_type='Molecule'
         summary='Molecule: \n'
-        all_molecules=molecules([i for i in range(len(atoms))],atoms)
+        all_molecules=molecules([i for i in range(len(atoms))],atoms,neighbors)
         com=np.average(atoms.positions,axis=0)
         summary+='COM: '+str(com)+', min z: '+str(np.min(atoms.positions[:,2]))
     if vacuum_x and vacuum_y and (not vacuum_z):
@@ -303,7 +354,7 @@ def analyze(atoms):
         slabatoms=[ia for ia in range(len(atoms))]        
     ####END check
     if not (is_a_bulk or is_a_molecule or is_a_wire):
-        tipii,layersg=get_types(atoms,0.1)
+        tipii,layersg=get_types(atoms,0.1,neighbors)
         if vacuum_x:
             slabtype='YZ'
         elif vacuum_y:
@@ -318,7 +369,7 @@ def analyze(atoms):
         mol_atoms+=metalatings
         
         #identify separate molecules
-        all_molecules=molecules(mol_atoms,atoms)
+        all_molecules=molecules(mol_atoms,atoms,neighbors)
 
 
         ## bottom_H  
@@ -383,4 +434,66 @@ def analyze(atoms):
             'spins_up'      : spins_up,
             'spins_down'    : spins_down,
             'summary':summary
-           }
\ No newline at end of file
+           }
+# ## ----------------------------------------------------------------
+# ## ----------------------------------------------------------------
+# ## ----------------------------------------------------------------
+# ## Cached analysis of stored structures
+
+# increase when the analysis changes, results of older versions are recomputed
+ANALYZE_VERSION = 1
+
+ANALYZE_SET_KEYS = ('slab_elements', 'spins_up', 'spins_down')
+
+# results by structure uuid, in the serialized (extras) form,
+# the least recently used ones are dropped
+ANALYZE_CACHE_SIZE = 256
+_analyze_cache = OrderedDict()
+
+def _to_extra(value):
+    if isinstance(value, dict):
+        return {k: _to_extra(v) for k, v in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return sorted(_to_extra(v) for v in value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_extra(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def _from_extra(result, atoms):
+    result = copy.deepcopy(result)
+    for key in ANALYZE_SET_KEYS:
+        result[key] = set(result[key])
+    # not stored, one entry per atom
+    result['all_elements'] = atoms.get_chemical_symbols()
+    return result
+
+def analyze_node(structure, atoms=None):
+    """
+    analyze() of a StructureData. The result is cached by the structure uuid
+    and, for stored structures, kept in the extras 'analyze_result' and
+    'analyze_version'. atoms (structure.get_ase() by default) get the same
+    cell and pbc as with analyze().
+    """
+    if atoms is None:
+        atoms = structure.get_ase()
+    prepare_cell(atoms)
+    
+    result = _analyze_cache.get(structure.uuid)
+    if result is not None:
+        _analyze_cache.move_to_end(structure.uuid)
+    if result is None and structure.get_extra('analyze_version', None) == ANALYZE_VERSION:
+        result = structure.get_extra('analyze_result', None)
+    if result is None:
+        result = _to_extra(analyze(atoms))
+        del result['all_elements']
+        if structure.is_stored:
+            structure.set_extra_many({
+                'analyze_result': result,
+                'analyze_version': ANALYZE_VERSION,
+            })
+    _analyze_cache[structure.uuid] = result
+    while len(_analyze_cache) > ANALYZE_CACHE_SIZE:
+        _analyze_cache.popitem(last=False)
+    return _from_extra(result, atoms)
@@ -1,21 +1,28 @@
-from aiida.orm import WorkChainNode
+from aiida.orm import Node, ProcessNode, WorkChainNode, CalcJobNode
+from aiida.orm import StructureData
+from aiida.orm import Group
+from aiida.orm import Dict
 from aiida.orm import load_node
 
 from aiida.orm.querybuilder import QueryBuilder
 from aiida.orm import SinglefileData
 from aiida.orm import Code, Computer
-from aiida.engine import CalcJob
+from aiida.manage.manager import get_manager
+from aiida.plugins import GroupFactory
+from aiida.common.exceptions import NotExistent, EntryPointError
+from aiida.common.links import LinkType
 
-import subprocess
+import shlex
+import re
+import time
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import ase
 
-from io import StringIO, BytesIO
-import tempfile
-import shutil
+from io import BytesIO
 
 # ## ----------------------------------------------------------------
 # ## ----------------------------------------------------------------
@@ -126,6 +133,7 @@ workchain_preproc_and_viewer_info = {
             'viewer_path': "scanning_probe/stm/view_stm.ipynb",
             'retrieved_files': [(1, ["stm.npz"])], # [(step_index, list_of_retr_files), ...]
             'struct_label': 'structure',
+            'scf_label': 'scf_diag',
         },
     },
     'PdosWorkChain': {
@@ -134,6 +142,7 @@ workchain_preproc_and_viewer_info = {
             'viewer_path': "scanning_probe/pdos/view_pdos.ipynb",
             'retrieved_files': [(0, ["aiida-list1-1.pdos"]), (2, ["overlap.npz"])],
             'struct_label': 'slabsys_structure',
+            'scf_label': 'slab_scf',
         },
     },
     'AfmWorkChain': {
@@ -142,6 +151,7 @@ workchain_preproc_and_viewer_info = {
             'viewer_path': "scanning_probe/afm/view_afm.ipynb",
             'retrieved_files': [(1, ["df.npy"]), (2, ["df.npy"])],
             'struct_label': 'structure',
+            'scf_label': 'scf_diag',
         },
     },
     'OrbitalWorkChain': {
@@ -150,6 +160,7 @@ workchain_preproc_and_viewer_info = {
             'viewer_path': "scanning_probe/orb/view_orb.ipynb",
             'retrieved_files': [(1, ["orb.npz"])],
             'struct_label': 'structure',
+            'scf_label': 'scf_diag',
         },
     },
     'HRSTMWorkChain': {
@@ -158,12 +169,13 @@ workchain_preproc_and_viewer_info = {
             'viewer_path': "scanning_probe/hrstm/view_hrstm.ipynb",
             'retrieved_files': [(1, ["df.npy"]), (2, ['hrstm_meta.npy', 'hrstm.npz'])],
             'struct_label': 'structure',
+            'scf_label': 'scf_diag',
         },
     },
 }
 
 
-PREPROCESS_VERSION = 1.08
+PREPROCESS_VERSION = 1.10
 
 def preprocess_one(workcalc):
     """
@@ -204,30 +216,22 @@ def preprocess_one(workcalc):
     
     structure = workcalc.inputs[prepoc_info_dict['struct_label']]
     
-    # Add the link to the SPM calc to the structure extras in format STMWorkChain_1: <stm_wc_pk> 
-    pk_numbers = [e for e in structure.extras if e.startswith(workcalc_name)]
-    pk_numbers = [int(e.split('_')[1]) for e in pk_numbers if e.split('_')[1].isdigit()]
-    pks = [e[1] for e in structure.extras.items() if e[0].startswith(workcalc_name)]
-    if workcalc.pk in pks:
-        return
-    nr = 1
-    if len(pk_numbers) != 0:
-        for nr in range(1, 100):
-            if nr in pk_numbers:
-                continue
-            break
-    structure.set_extra('%s_%d_pk'% (workcalc_name, nr), workcalc.pk)
+    # Add the SPM calc to the index of the structure
+    add_to_spm_index(structure, [workcalc])
+    add_to_restart_wfn_catalog([(structure, workcalc)])
 
 
-def preprocess_spm_calcs(workchain_list = ['STMWorkChain', 'PdosWorkChain', 'AfmWorkChain', 'OrbitalWorkChain']):
+def preprocess_spm_calcs(workchain_list = ['STMWorkChain', 'PdosWorkChain', 'AfmWorkChain', 'OrbitalWorkChain'],
+                         bulk=True, incremental=False, workers=1):
+    if incremental:
+        preprocess_spm_calcs_incremental(workchain_list, workers=workers)
+        return
+    if bulk:
+        preprocess_spm_calcs_bulk(workchain_list, workers=workers)
+        return
+    
     qb = QueryBuilder()
-    qb.append(WorkChainNode, filters={
-        'attributes.process_label': {'in': workchain_list},
-        'or':[
-               {'extras': {'!has_key': 'preprocess_version'}},
-               {'extras.preprocess_version': {'<': PREPROCESS_VERSION}},
-           ],
-    })
+    qb.append(WorkChainNode, filters=_preprocess_filters(workchain_list))
     qb.order_by({WorkChainNode:{'ctime':'asc'}})
     
     for m in qb.all():
@@ -269,8 +273,606 @@ def preprocess_spm_calcs(workchain_list = ['STMWorkChain', 'PdosWorkChain', 'Afm
             n.set_extra('preprocess_version', PREPROCESS_VERSION)
             print("Failed to preprocess PK %d (%s): %s"%(n.pk, wc_name, e))
 
-def create_viewer_link_html(structure_extras, apps_path):
+# ## ----------------------------------------------------------------
+# ## Bulk preprocessing
+
+PREPROCESS_BATCH_SIZE = 1000
+
+# process states of a CalcJob that is still underway
+UNDERWAY_PROCESS_STATES = ('created', 'waiting', 'running')
+
+def _preprocess_filters(workchain_list):
+    return {
+        'attributes.process_label': {'in': workchain_list},
+        'or':[
+               {'extras': {'!has_key': 'preprocess_version'}},
+               {'extras.preprocess_version': {'<': PREPROCESS_VERSION}},
+           ],
+    }
+
+def _struct_link_labels():
+    return list(set(
+        info['struct_label']
+        for versions in workchain_preproc_and_viewer_info.values()
+        for info in versions.values()
+    ))
+
+def _query_spm_workchains(wc_filters):
+    """
+    Fetch everything the preprocessing needs in three projections, without
+    loading the nodes: columns of the workchains, the pks of their input
+    structures and the states of the called processes.
+    Returns a list of ({'pk', 'process_label', 'sealed', 'obsolete', 'version'},
+                       {link_label: structure_pk}, [(ctime, state, exit_status), ...])
+    """
+    wc_columns = ['id', 'attributes.process_label', 'attributes.sealed', 'extras.obsolete', 'extras.version']
+    workchains = []
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters=wc_filters, project=wc_columns)
+    qb.order_by({WorkChainNode:{'ctime':'asc'}})
+    for wc_pk, wc_name, sealed, obsolete, version in qb.iterall(batch_size=PREPROCESS_BATCH_SIZE):
+        workchains.append({
+            'pk': wc_pk,
+            'process_label': wc_name,
+            'sealed': bool(sealed),
+            'obsolete': obsolete,
+            'version': 0 if version is None else version,
+        })
+    
+    structures = {}
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters=wc_filters, project=['id'], tag='wc')
+    qb.append(StructureData, with_outgoing='wc', project=['id'],
+              edge_filters={'label': {'in': _struct_link_labels()}}, edge_project=['label'])
+    for wc_pk, struct_pk, link_label in qb.iterall(batch_size=PREPROCESS_BATCH_SIZE):
+        structures.setdefault(wc_pk, {})[link_label] = struct_pk
+    
+    # all called processes (calculations and sub-workchains), as workcalc.called
+    called = {}
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters=wc_filters, project=['id'], tag='wc')
+    qb.append(ProcessNode, with_incoming='wc',
+              edge_filters={'type': {'in': [LinkType.CALL_CALC.value, LinkType.CALL_WORK.value]}},
+              project=['ctime', 'attributes.process_state', 'attributes.exit_status'])
+    for wc_pk, ctime, state, exit_status in qb.iterall(batch_size=PREPROCESS_BATCH_SIZE):
+        called.setdefault(wc_pk, []).append((ctime, state, exit_status))
+    
+    return [(wc, structures.get(wc['pk'], {}), sorted(called.get(wc['pk'], []), key=lambda c: c[0]))
+            for wc in workchains]
+
+def _preprocess_one_bulk(wc, structures, calls):
+    """
+    Bulk counterpart of preprocess_one, works only on the projected data.
+    Returns the pk of the input structure that the SPM calc should be indexed under
+    """
+    prepoc_info_dict = workchain_preproc_and_viewer_info[wc['process_label']][wc['version']]
+    
+    if len(calls) < prepoc_info_dict['n_calls']:
+        raise(Exception("Not all calculations started."))
+    
+    _, last_state, last_exit_status = calls[-1]
+    if last_state != 'finished' or last_exit_status != 0:
+        raise(Exception("CP2K calculation didn't finish well."))
+    
+    structure_pk = structures.get(prepoc_info_dict['struct_label'])
+    if structure_pk is None:
+        raise(Exception("Input structure '%s' not found." % prepoc_info_dict['struct_label']))
+    
+    return structure_pk
+
+def _load_nodes(pks):
+    """ {pk: node} of the given pks, loaded with one query per batch """
+    nodes = {}
+    pks = list(set(pks))
+    for i_start in range(0, len(pks), PREPROCESS_BATCH_SIZE):
+        qb = QueryBuilder()
+        qb.append(Node, filters={'id': {'in': pks[i_start:i_start+PREPROCESS_BATCH_SIZE]}})
+        for node in qb.all(flat=True):
+            nodes[node.pk] = node
+    return nodes
+
+def _write_extras_in_batches(node_updates, batch_size=PREPROCESS_BATCH_SIZE):
+    """
+    node_updates: list of (node pk, {key: value} to set, [keys to delete])
+    The nodes of a batch are loaded with one query and written in a single database transaction.
+    """
+    backend = get_manager().get_backend()
+    for i_start in range(0, len(node_updates), batch_size):
+        batch = node_updates[i_start:i_start+batch_size]
+        nodes = _load_nodes([pk for pk, _, _ in batch])
+        with backend.transaction():
+            for pk, set_extras, del_extras in batch:
+                node = nodes[pk]
+                if set_extras:
+                    node.set_extra_many(set_extras)
+                for key in del_extras:
+                    if key in node.extras:
+                        node.delete_extra(key)
+
+def _load_index_links(pk_links):
+    """ (structure_pk, wc_pk) -> (structure, workchain) """
+    nodes = _load_nodes([pk for link in pk_links for pk in link])
+    return [(nodes[s_pk], nodes[wc_pk]) for s_pk, wc_pk in pk_links]
+
+def _preprocess_workchains(wc_filters):
+    """
+    Examines the SPM workchains matching wc_filters.
+    Returns (summary, index_links, node_updates), with the index links
+    as (structure_pk, wc_pk) and the extras updates by workchain pk.
+    Nothing is written.
+    """
+    summary = {'examined': [], 'underway': [], 'successful': [], 'failed': [], 'retry': []}
+    
+    node_updates = []
+    index_links = []
+    
+    for wc, structures, calls in _query_spm_workchains(wc_filters):
+        wc_pk = wc['pk']
+        summary['examined'].append(wc_pk)
+        ## ---------------------------------------------------------------
+        ## calculation not finished
+        if not wc['sealed']:
+            print("Skipping underway workchain PK %d"%wc_pk)
+            summary['underway'].append(wc_pk)
+            continue
+        if any(c[1] in UNDERWAY_PROCESS_STATES for c in calls):
+            print("Skipping underway workchain PK %d"%wc_pk)
+            summary['underway'].append(wc_pk)
+            continue
+        ## ---------------------------------------------------------------
+        
+        set_extras = {}
+        if wc['obsolete'] is None:
+            set_extras['obsolete'] = False
+        if wc['obsolete']:
+            continue
+        
+        wc_name = wc['process_label']
+        
+        try:
+            structure_pk = _preprocess_one_bulk(wc, structures, calls)
+            index_links.append((structure_pk, wc_pk))
+            summary['successful'].append(wc_pk)
+            print("Preprocessed PK %d (%s)"%(wc_pk, wc_name))
+            
+            set_extras['preprocess_successful'] = True
+            set_extras['preprocess_version'] = PREPROCESS_VERSION
+            node_updates.append((wc_pk, set_extras, ['preprocess_error']))
+            
+        except Exception as e:
+            set_extras['preprocess_successful'] = False
+            set_extras['preprocess_error'] = str(e)
+            set_extras['preprocess_version'] = PREPROCESS_VERSION
+            node_updates.append((wc_pk, set_extras, []))
+            summary['failed'].append((wc_pk, str(e)))
+            print("Failed to preprocess PK %d (%s): %s"%(wc_pk, wc_name, e))
+    
+    return summary, index_links, node_updates
+
+def _print_preprocess_summary(summary):
+    print("Preprocessing done: %d examined, %d successful, %d failed, %d underway" % (
+        len(summary['examined']), len(summary['successful']),
+        len(summary['failed']), len(summary['underway'])))
+    for pk, error in summary['failed']:
+        print("  failed PK %d: %s" % (pk, error))
+    if len(summary['retry']) > 0:
+        print("  %d workchains were not preprocessed and will be retried" % len(summary['retry']))
+
+def preprocess_spm_calcs_bulk(workchain_list = ['STMWorkChain', 'PdosWorkChain', 'AfmWorkChain', 'OrbitalWorkChain'],
+                              wc_filters=None, workers=1):
+    """
+    Same as preprocess_spm_calcs, but the process states, labels, extras and
+    the input structures are obtained with a few QueryBuilder projections and
+    the resulting extras are written in batched transactions.
+    With workers > 1 the workchains are examined in parallel, see preprocess_spm_calcs_parallel.
+    
+    Returns a summary dict with the pks of the examined, underway and successful
+    workchains, (pk, error) of the failed ones and the pks that have to be retried
+    (their extras were not written)
+    """
+    if wc_filters is None:
+        wc_filters = _preprocess_filters(workchain_list)
+    
+    if workers > 1:
+        return preprocess_spm_calcs_parallel(wc_filters, workers)
+    
+    summary, pk_links, node_updates = _preprocess_workchains(wc_filters)
+    index_links = _load_index_links(pk_links)
+    
+    _add_to_spm_index_in_batches(index_links)
+    add_to_restart_wfn_catalog(index_links)
+    _write_extras_in_batches(node_updates)
+    _print_preprocess_summary(summary)
+    return summary
+
+# ## ----------------------------------------------------------------
+# ## Parallel preprocessing
+
+# Number of workchains handed to a worker at once
+PARALLEL_BATCH_SIZE = 200
+
+def _preprocess_worker(wc_pks):
+    """
+    Examines one batch of workchains, nothing is written.
+    Returns (summary, index links, extras updates) by pk, as the nodes
+    are bound to the database session of the worker thread.
+    """
+    return _preprocess_workchains({'id': {'in': wc_pks}})
+
+def preprocess_spm_calcs_parallel(wc_filters, workers):
+    """
+    Examines the workchains matching wc_filters in batches on a pool of worker threads.
+    Threads are used instead of processes as the database connection is not fork-safe,
+    each thread gets its own database session.
+    
+    The structure index and the restart wfn catalogs are shared between batches,
+    so they are only updated from the calling thread once all workers are done.
+    As in the serial mode, the extras (which mark the workchains as preprocessed)
+    are written last, so an interrupted pass leaves them to be preprocessed again.
+    """
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters=wc_filters, project=['id'])
+    qb.order_by({WorkChainNode:{'ctime':'asc'}})
+    wc_pks = qb.all(flat=True)
+    
+    batches = [wc_pks[i:i+PARALLEL_BATCH_SIZE] for i in range(0, len(wc_pks), PARALLEL_BATCH_SIZE)]
+    
+    summary = {'examined': [], 'underway': [], 'successful': [], 'failed': [], 'retry': []}
+    pk_links = []
+    node_updates = []
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_preprocess_worker, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                batch_summary, batch_links, batch_updates = future.result()
+            except Exception as e:
+                # no extras are written for this batch, the workchains are retried next time
+                batch = futures[future]
+                print("Failed to preprocess batch of %d workchains: %s" % (len(batch), e))
+                summary['examined'] += batch
+                summary['failed'] += [(pk, str(e)) for pk in batch]
+                summary['retry'] += batch
+                continue
+            for key in summary:
+                summary[key] += batch_summary[key]
+            pk_links += batch_links
+            node_updates += batch_updates
+    
+    # keep the ctime order of the serial mode
+    order = {pk: i for i, pk in enumerate(wc_pks)}
+    pk_links.sort(key=lambda link: order[link[1]])
+    index_links = _load_index_links(pk_links)
+    
+    _add_to_spm_index_in_batches(index_links)
+    add_to_restart_wfn_catalog(index_links)
+    _write_extras_in_batches(sorted(node_updates, key=lambda update: order[update[0]]))
+    _print_preprocess_summary(summary)
+    return summary
+
+# ## ----------------------------------------------------------------
+# ## Incremental preprocessing
+
+# The watermark is stored in the extras of this group, of the internal 'spm.index'
+# group type (see SPM_INDEX_GROUP_TYPE), so it is not listed with the user's groups
+PREPROCESS_STATE_GROUP = 'scanning_probe_preprocess_state'
+
+def _find_preprocess_state_group(type_string):
+    qb = QueryBuilder()
+    qb.append(Group, filters={'type_string': type_string, 'label': PREPROCESS_STATE_GROUP})
+    res = qb.first()
+    return None if res is None else res[0]
+
+def get_preprocess_watermark():
+    """
+    Returns the stored watermark:
+    {'last_pk', 'preprocess_version', 'workchain_list', 'pending_pks'}
+    or None if no preprocessing has been recorded yet
+    """
+    group = _find_preprocess_state_group(SPM_INDEX_GROUP_TYPE)
+    if group is None:
+        # stored in a core group before, moved on the next update
+        group = _find_preprocess_state_group('core')
+    if group is None:
+        return None
+    return group.get_extra('preprocess_watermark', None)
+
+def _set_preprocess_watermark(watermark):
+    group, _ = _spm_index_group_class().objects.get_or_create(label=PREPROCESS_STATE_GROUP)
+    group.set_extra('preprocess_watermark', watermark)
+    legacy_group = _find_preprocess_state_group('core')
+    if legacy_group is not None:
+        Group.objects.delete(legacy_group.pk)
+
+def mark_for_preprocess(pks):
+    """
+    Makes the next incremental preprocessing pass re-examine the given workchains,
+    e.g. after they were re-enabled in manage_calcs
+    """
+    watermark = get_preprocess_watermark()
+    if watermark is None:
+        return
+    watermark['pending_pks'] = sorted(set(watermark['pending_pks']) | set(pks))
+    _set_preprocess_watermark(watermark)
+
+def _last_spm_workchain_pk(workchain_list):
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters={'attributes.process_label': {'in': workchain_list}},
+              project=['id'])
+    qb.order_by({WorkChainNode: {'id': 'desc'}})
+    qb.limit(1)
+    res = qb.first()
+    if res is None:
+        return 0
+    return res[0]
+
+def preprocess_spm_calcs_incremental(workchain_list = ['STMWorkChain', 'PdosWorkChain', 'AfmWorkChain', 'OrbitalWorkChain'],
+                                     workers=1):
+    """
+    Only examines the SPM workchains created after the stored watermark and the ones
+    that were still underway, could not be examined (failed batches)
+    or were marked for preprocessing during the last pass.
+    
+    If there is no watermark or PREPROCESS_VERSION changed, a one-off migration pass
+    over all workchains with an older preprocess_version is done instead.
+    """
+    watermark = get_preprocess_watermark()
+    
+    migrate = (
+        watermark is None or
+        watermark['preprocess_version'] != PREPROCESS_VERSION or
+        sorted(watermark['workchain_list']) != sorted(workchain_list)
+    )
+    
+    # Determine the new watermark before the pass, to not miss anything created meanwhile
+    last_pk = _last_spm_workchain_pk(workchain_list)
+    
+    if migrate:
+        print("Preprocess version %s: migrating all SPM workchains" % PREPROCESS_VERSION)
+        migrate_structure_extras_to_index()
+        wc_filters = _preprocess_filters(workchain_list)
+        wc_filters['id'] = {'<=': last_pk}
+        summary = preprocess_spm_calcs_bulk(workchain_list, wc_filters=wc_filters, workers=workers)
+    else:
+        new_or_pending = [{'id': {'>': watermark['last_pk']}}]
+        if len(watermark['pending_pks']) > 0:
+            new_or_pending.append({'id': {'in': watermark['pending_pks']}})
+        wc_filters = {
+            'attributes.process_label': {'in': workchain_list},
+            'id': {'<=': last_pk},
+            'or': new_or_pending,
+        }
+        summary = preprocess_spm_calcs_bulk(workchain_list, wc_filters=wc_filters, workers=workers)
+    
+    _set_preprocess_watermark({
+        'last_pk': last_pk,
+        'preprocess_version': PREPROCESS_VERSION,
+        'workchain_list': sorted(workchain_list),
+        'pending_pks': sorted(set(summary['underway']) | set(summary['retry'])),
+    })
+
+# ## ----------------------------------------------------------------
+# ## Structure -> SPM results index
+
+# The SPM workchains of a structure are members of the group <prefix><structure uuid>,
+# of the own group type 'spm.index', so they don't show up among the user's groups
+SPM_INDEX_GROUP_PREFIX = 'scanning_probe_spm_index_'
+SPM_INDEX_GROUP_TYPE = 'spm.index'
+
+# Legacy structure extras in format STMWorkChain_1_pk: <stm_wc_pk>
+LEGACY_SPM_EXTRA_RE = re.compile(r'^(\w+WorkChain)_(\d+)_pk$')
+
+def spm_index_group_label(structure_uuid):
+    return SPM_INDEX_GROUP_PREFIX + structure_uuid
+
+def _spm_index_group_class():
+    """
+    Group class of the index groups. Only needed to create them, the queries filter
+    by the type string, so the module also works if the entry point is not registered.
+    """
+    try:
+        return GroupFactory(SPM_INDEX_GROUP_TYPE)
+    except EntryPointError as exc:
+        raise EntryPointError(
+            "The '%s' group type is not registered, reinstall the scanning probe app "
+            "(pip install -e .) or run 'reentry scan': %s" % (SPM_INDEX_GROUP_TYPE, exc))
+
+def _spm_index_group_filters(label):
+    return {'type_string': SPM_INDEX_GROUP_TYPE, 'label': label}
+
+def add_to_spm_index(structure, workchains):
+    group, _ = _spm_index_group_class().objects.get_or_create(label=spm_index_group_label(structure.uuid))
+    group.add_nodes(list(workchains))
+    _add_legacy_spm_extras(structure, workchains)
+
+def _add_legacy_spm_extras(structure, workchains):
+    """
+    Also links the workchains in the legacy '<WorkChain>_<nr>_pk' structure extras,
+    which create_viewer_link_html (used by the browse pages) still reads
+    """
+    numbers = {}
+    linked_pks = set()
+    for key, val in structure.extras.items():
+        match = LEGACY_SPM_EXTRA_RE.match(key)
+        if match:
+            numbers.setdefault(match.group(1), set()).add(int(match.group(2)))
+            linked_pks.add(val)
+    
+    new_extras = {}
+    for wc in workchains:
+        if wc.pk in linked_pks:
+            continue
+        wc_name = wc.process_label
+        used = numbers.setdefault(wc_name, set())
+        nr = 1
+        while nr in used:
+            nr += 1
+        used.add(nr)
+        linked_pks.add(wc.pk)
+        new_extras['%s_%d_pk' % (wc_name, nr)] = wc.pk
+    if len(new_extras) > 0:
+        structure.set_extra_many(new_extras)
+
+def remove_from_spm_index(structure, workchain):
+    qb = QueryBuilder()
+    qb.append(Group, filters=_spm_index_group_filters(spm_index_group_label(structure.uuid)))
+    for group in qb.all(flat=True):
+        group.remove_nodes([workchain])
+        catalog = group.get_extra(RESTART_WFN_EXTRA, [])
+        group.set_extra(RESTART_WFN_EXTRA, [e for e in catalog if e['pk'] != workchain.pk])
+
+def _get_spm_index_groups(structure_uuids):
+    """
+    Index groups of the structures, the missing ones are created.
+    Returns {structure_uuid: group}
+    """
+    label_to_uuid = {spm_index_group_label(uuid): uuid for uuid in structure_uuids}
+    groups = {}
+    if len(label_to_uuid) == 0:
+        return groups
+    qb = QueryBuilder()
+    qb.append(Group, filters=_spm_index_group_filters({'in': list(label_to_uuid)}))
+    for group in qb.all(flat=True):
+        groups[label_to_uuid[group.label]] = group
+    for label, uuid in label_to_uuid.items():
+        if uuid not in groups:
+            groups[uuid], _ = _spm_index_group_class().objects.get_or_create(label=label)
+    return groups
+
+def _find_spm_index_group(structure_uuid):
+    """ Index group of the structure or None, nothing is created """
+    qb = QueryBuilder()
+    qb.append(Group, filters=_spm_index_group_filters(spm_index_group_label(structure_uuid)))
+    res = qb.first()
+    return None if res is None else res[0]
+
+def get_spm_results(structure_uuids, workchain_list=None):
+    """
+    All SPM results of the given structures, obtained with a single query.
+    Returns {structure_uuid: [(wc_pk, process_label, version), ...]} ordered by creation time
+    """
+    label_to_uuid = {spm_index_group_label(uuid): uuid for uuid in structure_uuids}
+    results = {uuid: [] for uuid in structure_uuids}
+    if len(label_to_uuid) == 0:
+        return results
+    
+    wc_filters = {}
+    if workchain_list is not None:
+        wc_filters['attributes.process_label'] = {'in': workchain_list}
+    
+    qb = QueryBuilder()
+    qb.append(Group, filters=_spm_index_group_filters({'in': list(label_to_uuid)}),
+              project=['label'], tag='group')
+    qb.append(WorkChainNode, with_group='group', filters=wc_filters,
+              project=['id', 'attributes.process_label', 'extras.version'])
+    qb.order_by({WorkChainNode: {'ctime': 'asc'}})
+    for label, wc_pk, wc_name, ver in qb.iterall():
+        results[label_to_uuid[label]].append((wc_pk, wc_name, 0 if ver is None else ver))
+    return results
+
+def _add_to_spm_index_in_batches(index_links):
+    """
+    index_links: list of (structure, workchain)
+    Only the workchains that are not yet in the index are added
+    """
+    by_structure = OrderedDict()
+    for structure, wc in index_links:
+        by_structure.setdefault(structure.uuid, (structure, []))[1].append(wc)
+    
+    uuids = list(by_structure)
+    for i_start in range(0, len(uuids), PREPROCESS_BATCH_SIZE):
+        batch = uuids[i_start:i_start+PREPROCESS_BATCH_SIZE]
+        indexed = get_spm_results(batch)
+        for uuid in batch:
+            structure, wcs = by_structure[uuid]
+            indexed_pks = set(r[0] for r in indexed[uuid])
+            new_wcs = [wc for wc in wcs if wc.pk not in indexed_pks]
+            if len(new_wcs) > 0:
+                add_to_spm_index(structure, new_wcs)
+
+def migrate_structure_extras_to_index():
+    """
+    Adds the SPM workchains that are linked with the legacy '<WorkChain>_<nr>_pk'
+    structure extras to the index. The legacy extras are left untouched.
+    """
+    wc_names = list(workchain_preproc_and_viewer_info.keys())
+    
+    # all structures that are inputs of SPM workchains
+    structures = {}
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters={'attributes.process_label': {'in': wc_names}}, tag='wc')
+    qb.append(StructureData, with_outgoing='wc', project=['*'],
+              edge_filters={'label': {'in': _struct_link_labels()}})
+    for struct in qb.iterall(batch_size=PREPROCESS_BATCH_SIZE):
+        structures[struct[0].pk] = struct[0]
+    
+    linked = {}
+    for struct_pk, struct in structures.items():
+        for key, val in struct.extras.items():
+            match = LEGACY_SPM_EXTRA_RE.match(key)
+            if match and match.group(1) in workchain_preproc_and_viewer_info:
+                linked[int(val)] = struct_pk
+    if len(linked) == 0:
+        return
+    
+    wc_pks = list(linked)
+    index_links = []
+    for i_start in range(0, len(wc_pks), PREPROCESS_BATCH_SIZE):
+        batch = wc_pks[i_start:i_start+PREPROCESS_BATCH_SIZE]
+        qb = QueryBuilder()
+        qb.append(WorkChainNode, project=['*'], filters={
+            'id': {'in': batch},
+            'or': [{'extras': {'!has_key': 'obsolete'}}, {'extras.obsolete': False}],
+        })
+        for wc in qb.all(flat=True):
+            index_links.append((structures[linked[wc.pk]], wc))
+    
+    _add_to_spm_index_in_batches(index_links)
+    print("Migrated %d SPM links from structure extras" % len(index_links))
+
+def _viewer_link_html(spm_results, apps_path):
     calc_links_str = ""
+    numbers = {}
+    for spm_pk, wc_name, ver in spm_results:
+        if wc_name not in workchain_preproc_and_viewer_info:
+            continue
+        numbers[wc_name] = numbers.get(wc_name, 0) + 1
+        
+        link_name = wc_name.replace('WorkChain', '')
+        link_name = link_name.replace('Workchain', '')
+        
+        viewer_path = workchain_preproc_and_viewer_info[wc_name][ver]['viewer_path']
+        
+        calc_links_str += "<a target='_blank' href='%s?pk=%s'>%s %s</a><br />" % (
+            apps_path + viewer_path, spm_pk, link_name, numbers[wc_name])
+    return calc_links_str
+
+def create_viewer_links_html(structures, apps_path):
+    """
+    Batched version of create_structure_viewer_link_html for many structures (nodes or uuids):
+    all linked SPM workchains and their versions are obtained with a single query.
+    Returns {structure_uuid: html}
+    """
+    uuids = [s if isinstance(s, str) else s.uuid for s in structures]
+    spm_results = get_spm_results(uuids)
+    return {uuid: _viewer_link_html(spm_results[uuid], apps_path) for uuid in uuids}
+
+def create_structure_viewer_link_html(structure, apps_path):
+    """Viewer links of all SPM results of the structure node, from the index"""
+    return create_viewer_links_html([structure.uuid], apps_path)[structure.uuid]
+
+def _legacy_versions(spm_pks):
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters={'id': {'in': spm_pks}}, project=['id', 'extras.version'])
+    return {pk: (0 if ver is None else ver) for pk, ver in qb.iterall()}
+
+def create_viewer_link_html(structure_extras, apps_path):
+    """
+    Viewer links of the legacy '<WorkChain>_<nr>_pk' structure extras. These are still
+    written next to the index (see add_to_spm_index) for the callers of this function,
+    create_structure_viewer_link_html gives the same links from the index
+    """
+    links = []
     for key in sorted(structure_extras.keys()):
         key_sp = key.split('_')        
         if len(key_sp) < 2:
@@ -278,15 +880,18 @@ def create_viewer_link_html(structure_extras, apps_path):
         wc_name, nr = key.split('_')[:2]
         if wc_name not in workchain_preproc_and_viewer_info:
             continue
-            
+        links.append((wc_name, nr, int(structure_extras[key])))
+    
+    if len(links) == 0:
+        return ""
+    versions = _legacy_versions([l[2] for l in links])
+    
+    calc_links_str = ""
+    for wc_name, nr, spm_pk in links:
         link_name = wc_name.replace('WorkChain', '')
         link_name = link_name.replace('Workchain', '')
-        spm_pk = int(structure_extras[key])
         
-        spm_node = load_node(spm_pk)
-        ver = 0
-        if 'version' in spm_node.extras:
-            ver = spm_node.extras['version']
+        ver = versions.get(spm_pk, 0)
         
         viewer_path = workchain_preproc_and_viewer_info[wc_name][ver]['viewer_path']
         
@@ -296,17 +901,194 @@ def create_viewer_link_html(structure_extras, apps_path):
     return calc_links_str
 
 
+# ## ----------------------------------------------------------------
+# ## Restart wavefunction catalog
+
+# Stored in the extras of the SPM index group of the structure, list of
+# {'pk', 'source', 'hostname', 'uks', 'path', 'checked', 'exists'}
+RESTART_WFN_EXTRA = 'restart_wfns'
+
+# Seconds for which a remote check of a restart wavefunction is trusted
+RESTART_WFN_TTL = 24*3600
+
+def _restart_wfn_entries(wc_pks):
+    """
+    Catalog entries of the SCF restart wavefunctions of the SPM workchains,
+    obtained with two queries. Returns {wc_pk: entry}
+    """
+    scf_labels = list(set(
+        info['scf_label']
+        for versions in workchain_preproc_and_viewer_info.values()
+        for info in versions.values()
+    ))
+    
+    uks = {}
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters={'id': {'in': wc_pks}}, project=['id'], tag='wc')
+    qb.append(Dict, with_outgoing='wc', edge_filters={'label': 'dft_params'}, project=['attributes.uks'])
+    for wc_pk, wc_uks in qb.iterall():
+        uks[wc_pk] = bool(wc_uks)
+    
+    entries = {}
+    qb = QueryBuilder()
+    qb.append(WorkChainNode, filters={'id': {'in': wc_pks}}, tag='wc',
+              project=['id', 'attributes.process_label', 'extras.version'])
+    qb.append(CalcJobNode, with_incoming='wc', tag='calc',
+              filters={'label': {'in': scf_labels}, 'attributes.exit_status': 0},
+              project=['label', 'attributes.remote_workdir'])
+    qb.append(Computer, with_node='calc', project=['hostname'])
+    for wc_pk, wc_name, ver, label, remote_workdir, hostname in qb.iterall():
+        ver = 0 if ver is None else ver
+        if label != workchain_preproc_and_viewer_info[wc_name][ver]['scf_label']:
+            continue
+        entries[wc_pk] = {
+            'pk': wc_pk,
+            'source': "%s PK %d" % (wc_name, wc_pk),
+            'hostname': hostname,
+            'uks': uks.get(wc_pk, False),
+            'path': remote_workdir + "/aiida-RESTART.wfn",
+            'checked': None,
+            'exists': None,
+        }
+    return entries
+
+def _geo_opt_restart_wfn_entry(structure_node):
+    if structure_node.creator is None:
+        return None
+    geo_opt_calc = structure_node.creator
+    geo_comp = geo_opt_calc.computer
+    if geo_comp is None or 'parameters' not in geo_opt_calc.inputs or 'remote_folder' not in geo_opt_calc.outputs:
+        return None
+    return {
+        'pk': geo_opt_calc.pk,
+        'source': "geo_opt",
+        'hostname': geo_comp.hostname,
+        'uks': 'UKS' in dict(geo_opt_calc.inputs['parameters'])['FORCE_EVAL']['DFT'],
+        'path': geo_opt_calc.outputs.remote_folder.get_remote_path() + "/aiida-RESTART.wfn",
+        'checked': None,
+        'exists': None,
+    }
+
+def add_to_restart_wfn_catalog(index_links):
+    """
+    index_links: list of (structure, SPM workchain)
+    Adds the restart wavefunctions of the SCF steps to the catalogs of the structures
+    """
+    if len(index_links) == 0:
+        return
+    
+    uuid_to_pks = OrderedDict()
+    for structure, wc in index_links:
+        uuid_to_pks.setdefault(structure.uuid, []).append(wc.pk)
+    
+    backend = get_manager().get_backend()
+    uuids = list(uuid_to_pks)
+    for i_start in range(0, len(uuids), PREPROCESS_BATCH_SIZE):
+        batch = uuids[i_start:i_start+PREPROCESS_BATCH_SIZE]
+        entries = _restart_wfn_entries([pk for uuid in batch for pk in uuid_to_pks[uuid]])
+        groups = _get_spm_index_groups(batch)
+        with backend.transaction():
+            for uuid in batch:
+                catalog = groups[uuid].get_extra(RESTART_WFN_EXTRA, [])
+                known_paths = set(e['path'] for e in catalog)
+                new_entries = [entries[pk] for pk in uuid_to_pks[uuid]
+                               if pk in entries and entries[pk]['path'] not in known_paths]
+                if len(new_entries) > 0:
+                    groups[uuid].set_extra(RESTART_WFN_EXTRA, catalog + new_entries)
+
+def find_restart_wfn(structure_node, computer, uks=False, ttl=RESTART_WFN_TTL, transport=None):
+    """
+    Looks up a reusable restart wavefunction of the structure on the computer in the catalog.
+    Only the entries that were not checked within the last ttl seconds are checked
+    on the remote (all in one go), so repeated lookups don't need any remote calls.
+    Files found missing are remembered and not checked again.
+    Structures without SPM results get their index group once there is a check result
+    (e.g. of the geo opt wfn) to remember.
+    Returns the path or "" if there is none.
+    """
+    group = _find_spm_index_group(structure_node.uuid)
+    catalog = [] if group is None else group.get_extra(RESTART_WFN_EXTRA, [])
+    changed = False
+    
+    # the geo opt wfn is the last resort, added on the first lookup
+    if not any(e['source'] == 'geo_opt' for e in catalog):
+        geo_opt_entry = _geo_opt_restart_wfn_entry(structure_node)
+        if geo_opt_entry is not None:
+            catalog.append(geo_opt_entry)
+            changed = True
+    catalog.sort(key=lambda e: e['source'] == 'geo_opt')
+    
+    # files that are gone don't come back, so the missing ones are skipped
+    candidates = [e for e in catalog if e['hostname'] == computer.hostname and e['uks'] == uks
+                  and e['exists'] is not False]
+    
+    now = time.time()
+    stale = [e for e in candidates if e['checked'] is None or now - e['checked'] > ttl]
+    if len(stale) > 0:
+        files_exist = remote_files_exist(computer, [e['path'] for e in stale], transport=transport)
+        for entry, file_exists in zip(stale, files_exist):
+            entry['checked'] = now
+            entry['exists'] = file_exists
+        changed = True
+    
+    if changed and group is None:
+        try:
+            group, _ = _spm_index_group_class().objects.get_or_create(
+                label=spm_index_group_label(structure_node.uuid))
+        except EntryPointError:
+            # not cached until the group type is registered, the lookup itself still works
+            pass
+    if changed and group is not None:
+        group.set_extra(RESTART_WFN_EXTRA, catalog)
+    
+    for entry in candidates:
+        if entry['exists']:
+            print("Found .wfn from %s" % entry['source'])
+            return entry['path']
+    return ""
+
+
 # ## ----------------------------------------------------------------
 # ## ----------------------------------------------------------------
 # ## ----------------------------------------------------------------
 # ## Misc
 
-def get_calc_by_label(workcalc, label):
+# Sealed workchains don't change anymore, so the calculations they called
+# can be cached. workchain uuid -> {label: [calc, ...]}
+SUBCALC_CACHE_SIZE = 256
+_subcalc_cache = OrderedDict()
+
+def _get_subcalcs(workcalc):
+    subcalcs = _subcalc_cache.get(workcalc.uuid)
+    if subcalcs is not None:
+        _subcalc_cache.move_to_end(workcalc.uuid)
+        return subcalcs
+    
+    subcalcs = {}
     qb = QueryBuilder()
-    qb.append(WorkChainNode, filters={'uuid':workcalc.uuid})
-    qb.append(CalcJob, with_incoming=WorkChainNode, filters={'label':label})
-    assert qb.count() == 1
-    calc = qb.first()[0]
+    qb.append(WorkChainNode, filters={'uuid':workcalc.uuid}, tag='wc')
+    qb.append(CalcJobNode, with_incoming='wc', project=['label', '*'])
+    for label, calc in qb.iterall():
+        subcalcs.setdefault(label, []).append(calc)
+    
+    if workcalc.is_sealed:
+        _subcalc_cache[workcalc.uuid] = subcalcs
+        while len(_subcalc_cache) > SUBCALC_CACHE_SIZE:
+            _subcalc_cache.popitem(last=False)
+    return subcalcs
+
+def get_calcs_by_label(workcalc):
+    """
+    Returns the {label: CalcJobNode} map of all calculations called by the workchain,
+    obtained with a single query and memoized for sealed workchains.
+    Labels that are used by more than one calculation are left out.
+    """
+    return {label: calcs[0] for label, calcs in _get_subcalcs(workcalc).items() if len(calcs) == 1}
+
+def get_calc_by_label(workcalc, label):
+    calcs = _get_subcalcs(workcalc).get(label, [])
+    assert len(calcs) == 1
+    calc = calcs[0]
     assert(calc.is_finished_ok)
     return calc
 
@@ -338,58 +1120,43 @@ def get_slab_calc_info(struct_node):
         html = ""
     return html
 
+def remote_files_exist(computer, paths, transport=None):
+    """
+    Checks which of the files exist on the computer with a single remote command.
+    
+    Uses the AiiDA transport of the computer, or the given (already open) transport,
+    so one connection can be reused for several checks. Any transport works,
+    e.g. a LocalTransport for computers on localhost.
+    
+    Returns a list of bools in the order of paths
+    """
+    if len(paths) == 0:
+        return []
+    
+    cmd = "for f in %s; do if [ -f \"$f\" ]; then echo 1 ; else echo 0 ; fi; done" % (
+        " ".join(shlex.quote(p) for p in paths))
+    
+    if transport is None:
+        with computer.get_transport() as transport:
+            retval, stdout, stderr = transport.exec_command_wait(cmd)
+    else:
+        retval, stdout, stderr = transport.exec_command_wait(cmd)
+    
+    if retval != 0:
+        raise(Exception("Remote file check failed: %s" % stderr))
+    
+    f_exists = stdout.split()
+    if len(f_exists) != len(paths):
+        raise(Exception("Remote file check returned %d results for %d files: %s" % (
+            len(f_exists), len(paths), stdout)))
+    return [f == '1' for f in f_exists]
+
 def does_remote_file_exist(computer, path):
-    ssh_config = computer.get_configuration()
-    ssh_cmd = ["ssh"]
-    if 'proxy_command' in ssh_config:
-        ssh_cmd += ["-o", f"ProxyCommand={ssh_config['proxy_command']}"]
-    hostname = ""
-    if 'username' in ssh_config:
-        hostname += f"{ssh_config['username']}@"
-    hostname += f"{computer.hostname}"
-    ssh_cmd += [hostname]
-    ssh_cmd += [f"if [ -f {path} ]; then echo 1 ; else echo 0 ; fi"]
-    f_exists = subprocess.check_output(ssh_cmd).decode()
-    if f_exists[0] != '1':
-        return False
-    return True
+    return remote_files_exist(computer, [path])[0]
 
 def find_struct_wf(structure_node, computer):
-    # check spm
-    extras = structure_node.extras
-    for ex_k in extras.keys():
-        if ex_k.startswith(('stm', 'pdos', 'afm', 'orb', 'hrstm')):
-            spm_workchain = load_node(extras[ex_k])
-            
-            # if calc was done using UKS, don't reuse WFN
-            if not spm_workchain.inputs.dft_params['uks']:
-                
-                cp2k_scf_calc = get_calc_by_label(spm_workchain, 'scf_diag')
-                if cp2k_scf_calc.computer.hostname == computer.hostname:
-                    wfn_path = cp2k_scf_calc.outputs.remote_folder.get_remote_path() + "/aiida-RESTART.wfn"
-                    # check if it exists
-                    file_exists = does_remote_file_exist(computer, wfn_path)
-                    if file_exists:
-                        print("Found .wfn from %s"%ex_k)
-                        return wfn_path
-                    
-    # check geo opt
-    if structure_node.creator is not None:
-        geo_opt_calc = structure_node.creator
-        
-        # if the geo opt was done using UKS, don't reuse WFN
-        if 'UKS' not in dict(geo_opt_calc.inputs['parameters'])['FORCE_EVAL']['DFT']:
-        
-            geo_comp = geo_opt_calc.computer
-            if geo_comp is not None and geo_comp.hostname == computer.hostname:
-                wfn_path = geo_opt_calc.outputs.remote_folder.get_remote_path() + "/aiida-RESTART.wfn"
-                # check if it exists
-                file_exists = does_remote_file_exist(computer, wfn_path)
-                if file_exists:
-                    print("Found .wfn from geo_opt")
-                    return wfn_path
-    
-    return ""
+    # RKS restart wavefunctions of the SPM calcs and the geo opt of the structure
+    return find_restart_wfn(structure_node, computer)
 
 def comp_plugin_codes(computer_name, plugin_name):
     qb = QueryBuilder()
@@ -413,35 +1180,72 @@ def get_bbox(ase_atoms):
     return np.array([cx, cy, cz])
 
 def make_geom_file(atoms, filename, spin_guess=None):
-        # spin_guess = [[spin_up_indexes], [spin_down_indexes]]
-        tmpdir = tempfile.mkdtemp()
-        file_path = tmpdir + "/" + filename
-
-        orig_file = StringIO()
-        atoms.write(orig_file, format='xyz')
-        orig_file.seek(0)
-        all_lines = orig_file.readlines()
-        comment = all_lines[1] # with newline character!
-        orig_lines = all_lines[2:]
-        
-        modif_lines = []
-        for i_line, line in enumerate(orig_lines):
-            new_line = line
-            lsp = line.split()
-            if spin_guess is not None:
-                if i_line in spin_guess[0]:
-                    new_line = lsp[0]+"1 " + " ".join(lsp[1:])+"\n"
-                if i_line in spin_guess[1]:
-                    new_line = lsp[0]+"2 " + " ".join(lsp[1:])+"\n"
-            modif_lines.append(new_line)
-        
-        final_str = "%d\n%s" % (len(atoms), comment) + "".join(modif_lines)
+    # spin_guess = [[spin_up_indexes], [spin_down_indexes]]
+    # Same content as ase's xyz writer, but the spin guess atoms get the kind 1 or 2 (e.g. "Co1")
+    n_atoms = len(atoms)
+    
+    kinds = np.zeros(n_atoms, dtype=int)
+    if spin_guess is not None:
+        for i_kind, indexes in ((1, spin_guess[0]), (2, spin_guess[1])):
+            indexes = np.array(indexes, dtype=int)
+            kinds[indexes[(indexes >= 0) & (indexes < n_atoms)]] = i_kind
+    
+    # the spin-tagged lines have the whitespace between the columns collapsed
+    line_formats = np.where(kinds == 0,
+                            "%-2s %22.15f %22.15f %22.15f\n",
+                            "%s %.15f %.15f %.15f\n")
+    
+    columns = np.empty((n_atoms, 4), dtype=object)
+    columns[:, 0] = np.array(atoms.get_chemical_symbols(), dtype=object) + np.array(['', '1', '2'], dtype=object)[kinds]
+    columns[:, 1:] = atoms.positions
+    
+    final_str = "%d\n\n" % n_atoms + "".join(line_formats) % tuple(columns.ravel())
+    
+    return get_or_store_node(SinglefileData(file=BytesIO(final_str.encode()), filename=filename))
+
+# ## ----------------------------------------------------------------
+# ## Reuse of stored nodes with the same content
+
+# Nodes stored by get_or_store_node are labeled with this prefix + their content hash,
+# so they are found by the (indexed) label instead of scanning the hash extras
+REUSABLE_NODE_LABEL_PREFIX = 'spm_reusable_'
 
-        with open(file_path, 'w') as f:
-            f.write(final_str)
-        aiida_f = SinglefileData(file=file_path)
-        shutil.rmtree(tmpdir)
-        return aiida_f
+# content hash -> pk of the stored node, to skip the query for repeated content
+_stored_node_by_hash = {}
+
+def get_or_store_node(node):
+    """
+    Returns an already stored node of the same type and with the same content
+    (attributes and files) as the given node, or stores and returns the node itself.
+    Meant for unlabeled inputs that rarely change, e.g. settings or parameter files.
+    """
+    if node.is_stored:
+        return node
+    if node.label:
+        # the label is needed for the lookup
+        return node.store()
+    
+    node_hash = node.get_hash()
+    
+    if node_hash in _stored_node_by_hash:
+        try:
+            return load_node(_stored_node_by_hash[node_hash])
+        except NotExistent:
+            del _stored_node_by_hash[node_hash]
+    
+    label = REUSABLE_NODE_LABEL_PREFIX + node_hash
+    qb = QueryBuilder()
+    qb.append(type(node), subclassing=False, filters={'label': label})
+    qb.limit(1)
+    existing = qb.first()
+    if existing is not None:
+        node = existing[0]
+    else:
+        node.label = label
+        node.store()
+    
+    _stored_node_by_hash[node_hash] = node.pk
+    return node
 
 def check_if_calc_ok(self_, prev_calc):
     """Checks if a calculation finished well.
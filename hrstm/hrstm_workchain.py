@@ -76,7 +76,8 @@ class HRSTMWorkChain(WorkChain):
         inputs['parameters'] = self.inputs.ppm_params
         inputs['parent_calc_folder'] = self.ctx.scf_diag.outputs.remote_folder
         # TODO set atom types properly
-        inputs['atomtypes'] = SinglefileData(file="/home/aiida/apps/scanning_probe/hrstm/atomtypes_2pp.ini")
+        inputs['atomtypes'] = common.get_or_store_node(
+            SinglefileData(file="/home/aiida/apps/scanning_probe/hrstm/atomtypes_2pp.ini"))
         inputs['metadata']['options'] = {
             "resources": {"num_machines": 1},
             "max_wallclock_seconds": 21600,
@@ -129,7 +130,7 @@ class HRSTMWorkChain(WorkChain):
         tmpdir = tempfile.mkdtemp()
         geom_fn = tmpdir + '/geom.xyz'
         atoms.write(geom_fn)
-        geom_f = SinglefileData(file=geom_fn)
+        geom_f = common.get_or_store_node(SinglefileData(file=geom_fn))
         shutil.rmtree(tmpdir)
 
         inputs['file']['geom_coords'] = geom_f
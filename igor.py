@@ -5,8 +5,23 @@ Code is based on asetk module by Leopold Talirz
 """
 
 import re
+import io
+import mmap
+import time
+import struct
 import numpy as np
 
+# Number of data rows formatted at once
+WRITE_CHUNK_ROWS = 256
+
+# SetScale command, also with spaces after the commas, as written by Axis.__str__
+AXIS_RE = re.compile(r"SetScale/?P? (\w) ([^,]+),\s*([^,]+),\s*\"([^\"]*)\",\s*([^;\r\n]+?)[ \t]*(?:;|\r|$)", re.M)
+
+# WAVES line, with optional flags (e.g. /D, /N=(nx, ny)) and one or more wave names
+WAVES_RE = re.compile(rb"(?:^|(?<=\r))WAVES((?:/(?:N=\([^)]*\)|\w+))*)[ \t]+([^\r\n]+)", re.M)
+BEGIN_RE = re.compile(rb"\s*BEGIN[ \t]*(?:\r\n|\r|\n)")
+END_RE = re.compile(rb"(?:^|[\r\n])END\b")
+
 class Axis(object):
     """Represents an axis of an IGOR wave"""
 
@@ -35,7 +50,7 @@ class Axis(object):
         X SetScale/P x 0,2.01342281879195e-11,"m", data_00381_Up;
         SetScale d 0,0,"V", data_00381_Up
         """
-        match = re.search("SetScale/?P? (.) ([+-\.\de]+),([+-\.\de]+),\"(\w+)\",\s*(\w+)", string)
+        match = AXIS_RE.search(string)
         self.symbol = match.group(1)
         self.min = float(match.group(2))
         self.delta = float(match.group(3))
@@ -55,71 +70,37 @@ class Wave(object):
 
     def __str__(self):
         """Print IGOR wave"""
-        s = ""
-        s += "IGOR\n"
+        f = io.StringIO()
+        self.write_to(f)
+        return f.getvalue()
+
+    def write_to(self, f):
+        """Write IGOR wave to a text file object, the data block chunk by chunk"""
+        f.write("IGOR\n")
 
         dimstring = "("
         for i in range(len(self.data.shape)):
             dimstring += "{}, ".format(self.data.shape[i])
         dimstring = dimstring[:-2] + ")" 
 
-        s += "WAVES/N={}  {}\n".format(dimstring, self.name)
-        s += "BEGIN\n"
-        s += self.print_data()
-        s += "END\n"
+        f.write("WAVES/N={}  {}\n".format(dimstring, self.name))
+        f.write("BEGIN\n")
+        for chunk in self.data_chunks():
+            f.write(chunk)
+        f.write("END\n")
         for ax in self.axes:
-            s += str(ax)
-        return s
+            f.write(str(ax))
 
     def read(self, fname):
         """Read IGOR wave
         
         Should work for any dimension.
-        Tested so far only for 2d wave.
+        Reads the first wave of the file, see read_waves for all of them.
         """
-        f=open(fname, 'r')
-        content=f.read()
-        f.close()
-
-        lines = content.split("\r")
-
-        line = lines.pop(0)
-        if not line == "IGOR":
-            raise IOError("Files does not begin with 'IGOR'")
-
-        line = lines.pop(0)
-        while not re.match("WAVES",line):
-            line = lines.pop(0)
-        match = re.search("WAVES/N=\(([\d,]+)\)\s+(.+)",line)
-        grid = match.group(1).split(',')
-        grid = np.array(grid, dtype=int)
-        self.name = match.group(2)
-
-        line = lines.pop(0)
-        if not line == "BEGIN":
-            raise IOError("Missing 'BEGIN' statement of data block")
-
-        # read data
-        datastring = ""
-        line = lines.pop(0)
-        while not re.match("END",line):
-            datastring += line
-            line = lines.pop(0)
-        data = np.array(datastring.split(), dtype=float)
-        self.data = data.reshape(grid)
-
-        # read axes
-        line = lines.pop(0)
-        matches = re.findall("SetScale.+?(?:;|$)", line)
-        self.axes = []
-        for match in matches:
-            ax = Axis(None,None,None,None)
-            ax.read(match)
-            self.axes.append(ax)
-
-        # the rest is discarded...
-        #line = lines.pop(0)
-        #print(line)
+        wave = read_waves(fname)[0]
+        self.name = wave.name
+        self.data = wave.data
+        self.axes = wave.axes
 
     @property
     def extent(self):
@@ -135,15 +116,32 @@ class Wave(object):
 
 
     def print_data(self):
-        """Determines how to print the data block.
+        """Returns the data block"""
+        return "".join(self.data_chunks())
+
+    def data_chunks(self):
+        """Yields the data block in pieces.
         
         To be implemented by subclasses."""
+        return iter(())
 
     def write(self, fname):
         f=open(fname, 'w')
-        f.write(str(self))
+        self.write_to(f)
         f.close()
 
+    def write_ibw(self, f):
+        """Write the wave in the binary Igor format (.ibw, version 5)
+
+        f is a file name or a binary file object (e.g. a zip entry).
+        The data is written straight from the array buffer.
+        """
+        if isinstance(f, str):
+            with open(f, 'wb') as fh:
+                self.write_ibw(fh)
+            return
+        write_ibw(f, self.data, self.axes, self.name)
+
 
 class Wave1d(Wave):
     """1d Igor wave"""
@@ -172,12 +170,11 @@ class Wave1d(Wave):
                     wavename=self.name)
             self.axes = [x]
 
-    def print_data(self):
-        s = ""
-        for line in self.data:
-            s += "{:12.6e}\n".format(float(line))
-
-        return s
+    def data_chunks(self):
+        values = np.asarray(self.data, dtype=float).reshape(len(self.data))
+        for i_start in range(0, len(values), WRITE_CHUNK_ROWS):
+            chunk = values[i_start:i_start+WRITE_CHUNK_ROWS]
+            yield ("%12.6e\n" * len(chunk)) % tuple(chunk.tolist())
          
 
 
@@ -236,13 +233,220 @@ class Wave2d(Wave):
             self.axes = [x,y]
 
 
-    def print_data(self):
-        """Determines how to print the data block"""
-        s = ""
-        for line in self.data:
-            for x in line:
-                s += "{:12.6e} ".format(x)
-            s += "\n"
+    def data_chunks(self):
+        """Yields the data block, a chunk of lines at a time"""
+        return _row_chunks(np.asarray(self.data))
 
-        return s
-         
+
+class WaveNd(Wave):
+    """Igor wave of 3 or 4 dimensions, see Wave3d and Wave4d"""
+
+    symbols = ()
+
+    def __init__(self, data=None, axes=None, name=None, **kwargs):
+        """Initialize N-d Igor wave
+
+        Parameters
+        ----------
+
+         * data
+         * name
+         * <s>min, <s>delta, <s>label for every axis symbol <s> (x, y, z, t)
+        """
+        super(WaveNd, self).__init__(data, axes=axes, name=name)
+
+        self.parameters = {}
+        for symb in self.symbols:
+            self.parameters.update({symb+'min': 0.0, symb+'delta': 1.0, symb+'label': symb})
+        for key, value in kwargs.items():
+            if key in self.parameters:
+                self.parameters[key] = value
+            else:
+                raise KeyError("Unknown parameter {}".format(key))
+
+        if axes is None:
+            p=self.parameters
+            self.axes = [
+                Axis(symbol=symb, min=p[symb+'min'], delta=p[symb+'delta'],
+                     unit=p[symb+'label'], wavename=self.name)
+                for symb in self.symbols
+            ]
+
+    def data_chunks(self):
+        """Yields the data block: the layers (and chunks) are
+        blocks of rows separated by an empty line, as Igor expects"""
+        data = np.asarray(self.data)
+        for i_layer, index in enumerate(np.ndindex(*data.shape[:1:-1])):
+            if i_layer > 0:
+                yield "\n"
+            for chunk in _row_chunks(data[(Ellipsis, ) + index[::-1]]):
+                yield chunk
+
+
+class Wave3d(WaveNd):
+    """3d Igor wave"""
+    symbols = ('x', 'y', 'z')
+
+
+class Wave4d(WaveNd):
+    """4d Igor wave"""
+    symbols = ('x', 'y', 'z', 't')
+
+
+def _row_chunks(data):
+    """Yields the lines of a 2d array, a chunk of lines at a time"""
+    row_format = "%12.6e " * data.shape[1] + "\n"
+    for i_start in range(0, data.shape[0], WRITE_CHUNK_ROWS):
+        chunk = data[i_start:i_start+WRITE_CHUNK_ROWS]
+        yield (row_format * len(chunk)) % tuple(chunk.ravel().tolist())
+
+
+
+def _wave_class(ndim):
+    return {1: Wave1d, 2: Wave2d, 3: Wave3d, 4: Wave4d}.get(ndim, Wave)
+
+def read_waves(fname):
+    """Read all waves of an IGOR text file
+
+    The file is memory-mapped and each data block is parsed in one go,
+    so large waves are read in linear time. Works with \\n, \\r\\n and \\r line ends.
+    A WAVES line with several names and no /N dimensions gives a 1d wave per column.
+    Returns a list of waves.
+    """
+    with open(fname, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+
+            if content[:4] != b"IGOR":
+                raise IOError("Files does not begin with 'IGOR'")
+
+            headers = list(WAVES_RE.finditer(content))
+            waves = []
+
+            for i_wave, header in enumerate(headers):
+                flags = header.group(1).decode()
+                names = header.group(2).decode().split()
+
+                begin = BEGIN_RE.match(content, header.end())
+                if begin is None:
+                    raise IOError("Missing 'BEGIN' statement of data block")
+
+                end = END_RE.search(content, begin.end())
+                if end is None:
+                    raise IOError("Missing 'END' statement of data block")
+
+                data = np.fromstring(content[begin.end():end.start()].decode(), dtype=float, sep=' ')
+
+                # axes are set by the commands between END and the next wave
+                next_start = headers[i_wave+1].start() if i_wave+1 < len(headers) else len(content)
+                commands = content[end.end():next_start].decode()
+
+                dims = re.search(r"N=\(([^)]*)\)", flags)
+                if dims is not None:
+                    grid = [int(n) for n in dims.group(1).split(',')]
+                    if len(grid) > 2:
+                        # blocks of rows x columns for every layer (and chunk)
+                        block_grid = grid[:1:-1] + grid[:2]
+                        axes_order = list(range(len(grid)-2, len(grid))) + list(range(len(grid)-3, -1, -1))
+                        wave_data = [data.reshape(block_grid).transpose(axes_order)]
+                    else:
+                        wave_data = [data.reshape(grid)]
+                    names = [" ".join(names)]
+                else:
+                    wave_data = list(data.reshape(-1, len(names)).T)
+
+                for name, d in zip(names, wave_data):
+                    axes = []
+                    for match in AXIS_RE.finditer(commands):
+                        if match.group(5).strip() != name and len(names) > 1:
+                            continue
+                        ax = Axis(None,None,None,None)
+                        ax.read(match.group(0))
+                        axes.append(ax)
+                    wave = _wave_class(d.ndim)(data=d, axes=axes, name=name)
+                    waves.append(wave)
+
+    return waves
+
+
+# ## ----------------------------------------------------------------
+# ## Binary Igor waves (.ibw), see Igor Technical Note 003
+
+# Igor number types
+IBW_TYPES = {
+    np.dtype(np.float32): 2,
+    np.dtype(np.float64): 4,
+    np.dtype(np.int8): 8,
+    np.dtype(np.int16): 0x10,
+    np.dtype(np.int32): 0x20,
+    np.dtype(np.uint8): 8 | 0x40,
+    np.dtype(np.uint16): 0x10 | 0x40,
+    np.dtype(np.uint32): 0x20 | 0x40,
+}
+
+# BinHeader5: version, checksum, wfmSize, formulaSize, noteSize, dataEUnitsSize,
+# dimEUnitsSize[4], dimLabelsSize[4], sIndicesSize, optionsSize1, optionsSize2
+IBW_BIN_HEADER5 = struct.Struct('<hhiiii4i4iiii')
+
+# WaveHeader5: next, creationDate, modDate, npnts, type, dLock, whpad1, whVersion,
+# bname, whpad2, dFolder, nDim[4], sfA[4], sfB[4], dataUnits, dimUnits[4][4],
+# fsValid, whpad3, topFullScale, botFullScale, dataEUnits, dimEUnits[4],
+# dimLabels[4], waveNoteH, whUnused[16], aModified, wModified, swModified,
+# useBits, kindBits, formula, depID, whpad4, srcFldr, fileName, sIndices
+IBW_WAVE_HEADER5 = struct.Struct('<IIIihh6sh32siI4i4d4d4s16shhddI4I4II16ihhhbbIihhII')
+
+# seconds between 1904-01-01 (Igor) and 1970-01-01 (unix)
+IGOR_EPOCH_OFFSET = 2082844800
+
+def write_ibw(f, data, axes, name):
+    """Write a wave of up to 4 dimensions as a version 5 .ibw to the binary file object f
+
+    The axes give the scaling (sfA = delta, sfB = min) and units of the dimensions,
+    units longer than 3 characters are stored as extended units.
+    """
+    data = np.asarray(data)
+    if data.dtype not in IBW_TYPES:
+        data = data.astype(np.float64)
+    if data.ndim > 4:
+        raise ValueError("Igor waves have at most 4 dimensions")
+
+    # Igor names are not quoted in binary waves
+    bname = name.strip("'").encode('ascii', 'replace')[:31]
+
+    n_dim = list(data.shape) + [0]*(4-data.ndim)
+    sf_a = [1.0]*4
+    sf_b = [0.0]*4
+    dim_units = [b'']*4
+    dim_eunits = [b'']*4
+    for i_ax, ax in enumerate([ax for ax in axes if ax.symbol in 'xyzt'][:data.ndim]):
+        sf_a[i_ax] = 1.0 if ax.delta is None else float(ax.delta)
+        sf_b[i_ax] = float(ax.min)
+        unit = ax.unit.encode('ascii', 'replace')
+        if len(unit) > 3:
+            dim_eunits[i_ax] = unit
+        else:
+            dim_units[i_ax] = unit
+
+    data_bytes = data.size * data.itemsize
+    now = int(time.time()) + IGOR_EPOCH_OFFSET
+
+    def pack_headers(checksum):
+        bin_header = IBW_BIN_HEADER5.pack(
+            5, checksum, IBW_WAVE_HEADER5.size + data_bytes, 0, 0, 0,
+            *([len(u) for u in dim_eunits] + [0]*4 + [0, 0, 0]))
+        wave_header = IBW_WAVE_HEADER5.pack(
+            0, now, now, data.size, IBW_TYPES[data.dtype], 0, b'', 1,
+            bname, 0, 0, *(n_dim + sf_a + sf_b + [b'', b''.join(u.ljust(4, b'\0') for u in dim_units),
+            0, 0, 0.0, 0.0, 0] + [0]*4 + [0]*4 + [0] + [0]*16 + [0]*11))
+        return bin_header + wave_header
+
+    # the shorts of both headers have to sum up to zero
+    headers = pack_headers(0)
+    checksum = -int(np.frombuffer(headers, dtype='<i2').sum(dtype=np.int64))
+    checksum = (checksum + 2**15) % 2**16 - 2**15
+    f.write(pack_headers(checksum))
+
+    # Igor stores the first dimension fastest
+    f.write(data.astype(data.dtype.newbyteorder('<')).tobytes(order='F'))
+
+    for unit in dim_eunits:
+        f.write(unit)
@@ -2,7 +2,6 @@ from aiida.orm import StructureData
 from aiida.orm import Dict
 from aiida.orm.nodes.data.array import ArrayData
 from aiida.orm import Int, Float, Str, Bool
-from aiida.orm import SinglefileData
 from aiida.orm import RemoteData
 from aiida.orm import Code
 
@@ -10,7 +9,7 @@ from aiida.engine import WorkChain, ToContext, while_
 
 from aiida_cp2k.calculations import Cp2kCalculation
 
-from io import StringIO, BytesIO
+from io import BytesIO
 
 from apps.scanning_probe import common
 
@@ -18,8 +17,6 @@ from aiida.plugins import CalculationFactory
 StmCalculation = CalculationFactory('spm.stm')
 
 import os
-import tempfile
-import shutil
 import numpy as np
 
 class OrbitalWorkChain(WorkChain):
@@ -76,7 +73,7 @@ class OrbitalWorkChain(WorkChain):
         } 
         
         # Need to make an explicit instance for the node to be stored to aiida
-        settings = Dict(dict={'additional_retrieve_list': ['orb.npz']})
+        settings = common.get_or_store_node(Dict(dict={'additional_retrieve_list': ['orb.npz']}))
         inputs['settings'] = settings
         
         self.report("Inputs: " + str(inputs))
@@ -147,9 +144,9 @@ class OrbitalWorkChain(WorkChain):
         inputs['parameters'] = Dict(dict=inp)
 
         # settings
-        settings = Dict(dict={'additional_retrieve_list': [
+        settings = common.get_or_store_node(Dict(dict={'additional_retrieve_list': [
             'aiida.inp', 'BASIS_MOLOPT', 'geom.xyz', 'aiida-RESTART.wfn'
-        ]})
+        ]}))
         inputs['settings'] = settings
 
         # resources
@@ -167,35 +164,7 @@ class OrbitalWorkChain(WorkChain):
     # ==========================================================================
     @classmethod
     def make_geom_file(cls, atoms, filename, spin_guess=None):
-        # spin_guess = [[spin_up_indexes], [spin_down_indexes]]
-        tmpdir = tempfile.mkdtemp()
-        file_path = tmpdir + "/" + filename
-
-        orig_file = StringIO()
-        atoms.write(orig_file, format='xyz')
-        orig_file.seek(0)
-        all_lines = orig_file.readlines()
-        comment = all_lines[1] # with newline character!
-        orig_lines = all_lines[2:]
-        
-        modif_lines = []
-        for i_line, line in enumerate(orig_lines):
-            new_line = line
-            lsp = line.split()
-            if spin_guess is not None:
-                if i_line in spin_guess[0]:
-                    new_line = lsp[0]+"1 " + " ".join(lsp[1:])+"\n"
-                if i_line in spin_guess[1]:
-                    new_line = lsp[0]+"2 " + " ".join(lsp[1:])+"\n"
-            modif_lines.append(new_line)
-        
-        final_str = "%d\n%s" % (len(atoms), comment) + "".join(modif_lines)
-
-        with open(file_path, 'w') as f:
-            f.write(final_str)
-        aiida_f = SinglefileData(file=file_path)
-        shutil.rmtree(tmpdir)
-        return aiida_f
+        return common.make_geom_file(atoms, filename, spin_guess)
 
     # ==========================================================================
     @classmethod
@@ -142,7 +142,7 @@ class PdosWorkChain(WorkChain):
             "max_wallclock_seconds": 86400,
         } 
         
-        settings = Dict(dict={'additional_retrieve_list': ['overlap.npz']})
+        settings = common.get_or_store_node(Dict(dict={'additional_retrieve_list': ['overlap.npz']}))
         inputs['settings'] = settings
         
         self.report("overlap inputs: " + str(inputs))
@@ -211,7 +211,7 @@ class PdosWorkChain(WorkChain):
         inputs['parameters'] = Dict(dict=inp)
 
         # settings
-        settings = Dict(dict={'additional_retrieve_list': ['*.pdos']})
+        settings = common.get_or_store_node(Dict(dict={'additional_retrieve_list': ['*.pdos']}))
         inputs['settings'] = settings
 
         # resources
@@ -0,0 +1,9 @@
+
+from aiida.orm import Group
+
+
+class SpmIndexGroup(Group):
+    """
+    SPM workchains of one structure (see common.add_to_spm_index).
+    Has its own type string, so the index groups are not listed with the user's groups.
+    """
@@ -1,8 +1,14 @@
 
 import os
 import io
-import zipfile
 import copy
+import threading
+import collections
+
+from collections import OrderedDict
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 
@@ -10,9 +16,11 @@ import ipywidgets as ipw
 from IPython.display import display, clear_output, HTML
 
 import matplotlib
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from apps.scanning_probe import igor
+from apps.scanning_probe import zip_export
 
 colormaps = ['seismic', 'gist_heat']
 
@@ -22,9 +30,11 @@ def remove_from_tuple(tup, index):
     return tuple(tmp_list)
 
 
-def make_plot(fig, ax, data, extent, title=None, title_size=None, center0=False, vmin=None, vmax=None, cmap='gist_heat', noadd=False):
+def make_plot(fig, ax, data, extent, title=None, title_size=None, center0=False, vmin=None, vmax=None, cmap='gist_heat', noadd=False,
+              data_amax=None):
     if center0:
-        data_amax = np.max(np.abs(data))
+        if data_amax is None:
+            data_amax = np.max(np.abs(data))
         im = ax.imshow(data.T, origin='lower', cmap=cmap, interpolation='bicubic', extent=extent, vmin=-data_amax, vmax=data_amax)
     else:
         im = ax.imshow(data.T, origin='lower', cmap=cmap, interpolation='bicubic', extent=extent, vmin=vmin, vmax=vmax)
@@ -92,13 +102,315 @@ def make_orb_label(index, homo_index):
     return "MO %d, " % index + hl_label
 
     
+# Number of energy slices of a derived series kept in memory
+DERIVED_CACHE_SIZE = 16
+
+class LazySeries():
+    """
+    Series [energy, x, y] derived from other series by a function of the energy slices,
+    e.g. the square of an orbital. Nothing is stored, the values are computed
+    on demand for the requested energies. The last few energy slices are cached
+    and returned read-only, as they are shared between the callers.
+    """
+    
+    def __init__(self, func, *sources, shape=None, cache_size=DERIVED_CACHE_SIZE):
+        self.func = func
+        self.sources = sources
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # same shape as the sources, unless func changes it (e.g. block_mean)
+        self.shape = tuple(shape) if shape is not None else sources[0].shape
+        self.ndim = len(self.shape)
+        self.dtype = np.result_type(*[src.dtype for src in sources])
+        self.size = int(np.prod(self.shape))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+    
+    def _energy_slice(self, i):
+        i = int(i) % self.shape[0]
+        # the exports read the series from a background thread
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+        result = self.func(*[np.asarray(src[i]) for src in self.sources])
+        result.setflags(write=False)
+        with self._lock:
+            self._cache[i] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        energy_key, rest = key[0], key[1:]
+        
+        if isinstance(energy_key, (int, np.integer)):
+            result = self._energy_slice(energy_key)
+        else:
+            # a range of energies (e.g. a chunk), not cached
+            result = self.func(*[np.asarray(src[energy_key]) for src in self.sources])
+            rest = (slice(None), ) + rest
+        
+        if len(rest) > 0:
+            result = result[rest]
+        return result
+
+# Size of the energy chunks the series statistics are computed on
+STATS_CHUNK_BYTES = 64*1024**2
+
+class SeriesStats():
+    """
+    Min, max and abs max of a series [energy, x, y] for each energy.
+    Computed once, a chunk of energies at a time, so the series doesn't have to fit
+    into memory (e.g. memmapped arrays). The statistics of a selection of energies
+    are then reduced from the per-energy values without touching the data.
+    """
+    
+    def __init__(self, data, chunk_bytes=STATS_CHUNK_BYTES):
+        n_e = data.shape[0]
+        
+        self.min = np.zeros(n_e)
+        self.max = np.zeros(n_e)
+        self.absmax = np.zeros(n_e)
+        
+        if n_e == 0:
+            return
+        
+        slice_bytes = max(1, data[0].size * data.dtype.itemsize)
+        chunk = max(1, chunk_bytes // slice_bytes)
+        
+        for i_start in range(0, n_e, chunk):
+            block = np.asarray(data[i_start:i_start+chunk])
+            block = block.reshape(block.shape[0], -1)
+            self.min[i_start:i_start+chunk] = np.min(block, axis=1)
+            self.max[i_start:i_start+chunk] = np.max(block, axis=1)
+        self.absmax = np.maximum(np.abs(self.min), np.abs(self.max))
+    
+    def range_min(self, index_list=None):
+        if index_list is None:
+            return np.min(self.min)
+        return np.min(self.min[index_list])
+    
+    def range_max(self, index_list=None):
+        if index_list is None:
+            return np.max(self.max)
+        return np.max(self.max[index_list])
+    
+    def range_absmax(self, index_list=None):
+        if index_list is None:
+            return np.max(self.absmax)
+        return np.max(self.absmax[index_list])
+
+# Coarsest pyramid level still has at least this many pixels along x and y
+PYRAMID_MIN_PIXELS = 128
+
+def block_mean(data):
+    """ 2x2 block average over the last two axes, an odd last row/column is repeated """
+    data = np.asarray(data)
+    odd = (data.shape[-2] % 2, data.shape[-1] % 2)
+    if any(odd):
+        # pad instead of dropping, otherwise the image shifts within the same extent
+        data = np.pad(data, [(0, 0)]*(data.ndim-2) + [(0, odd[0]), (0, odd[1])], mode='edge')
+    return 0.25 * (data[..., 0::2, 0::2] + data[..., 1::2, 0::2] +
+                   data[..., 0::2, 1::2] + data[..., 1::2, 1::2])
+
+def block_mean_shape(shape):
+    """ Shape of block_mean(data) for data of the given shape """
+    return tuple(shape[:-2]) + ((shape[-2]+1) // 2, (shape[-1]+1) // 2)
+
+class SeriesPyramid():
+    """
+    Downsampled levels of a series [energy, x, y] for on-screen display,
+    level k is block-averaged by 2^k; level 0 is the series itself.
+    The levels are only built when first asked for, a chunk of energies at a time.
+    The levels of a LazySeries are lazy as well, so that nothing is stored for them.
+    """
+    
+    def __init__(self, data, min_pixels=PYRAMID_MIN_PIXELS, chunk_bytes=STATS_CHUNK_BYTES):
+        self.data = data
+        self.min_pixels = min_pixels
+        self.chunk_bytes = chunk_bytes
+        self._levels = None
+        self._lock = threading.Lock()
+    
+    @property
+    def levels(self):
+        with self._lock:
+            if self._levels is None:
+                self._levels = self._build_levels()
+            return self._levels
+    
+    def _build_levels(self):
+        data = self.data
+        levels = [data]
+        
+        if data.shape[0] == 0 or min(data.shape[1:]) < 2*self.min_pixels:
+            return levels
+        
+        if isinstance(data, LazySeries):
+            while min(levels[-1].shape[1:]) >= 2*self.min_pixels:
+                levels.append(LazySeries(block_mean, levels[-1],
+                                         shape=block_mean_shape(levels[-1].shape)))
+            return levels
+        
+        n_e = data.shape[0]
+        slice_bytes = max(1, data[0].size * data.dtype.itemsize)
+        chunk = max(1, self.chunk_bytes // slice_bytes)
+        
+        level = None
+        for i_start in range(0, n_e, chunk):
+            block = block_mean(data[i_start:i_start+chunk])
+            if level is None:
+                level = np.zeros((n_e, ) + block.shape[1:], dtype=block.dtype)
+            level[i_start:i_start+chunk] = block
+        levels.append(level)
+        
+        while min(levels[-1].shape[1:]) >= 2*self.min_pixels:
+            levels.append(block_mean(levels[-1]))
+        return levels
+    
+    def level_for(self, nx_px, ny_px):
+        """ The coarsest level that still has at least nx_px x ny_px pixels """
+        levels = self.levels
+        for level in reversed(levels):
+            if level.shape[1] >= nx_px and level.shape[2] >= ny_px:
+                return level
+        return levels[0]
+
+# Memory bound of the rendered png cache
+PNG_CACHE_BYTES = 256*1024**2
+
+class PngCache():
+    """
+    LRU cache of rendered png bytes, bounded by their total size.
+    The keys contain everything the image depends on, see SeriesPlotter.png_key
+    """
+    
+    def __init__(self, max_bytes=PNG_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+            return png
+    
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                self.n_bytes -= len(self._cache.pop(key))
+            self._cache[key] = png
+            self.n_bytes += len(png)
+            while self.n_bytes > self.max_bytes:
+                _, old_png = self._cache.popitem(last=False)
+                self.n_bytes -= len(old_png)
+    
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.n_bytes = 0
+
+# Shared by all plotters in the kernel, the keys contain the workchain pk
+png_cache = PngCache()
+
+# Resolution of the exported pngs
+PNG_DPI = 200
+
+# The gallery pngs are re-encoded on every update, fast compression matters more than size
+GALLERY_PNG_OPTIONS = {'compress_level': 1}
+
+# Number of processes used to render the exported images. Capped by default,
+# as the AiiDAlab servers are shared; SPM_EXPORT_WORKERS overrides it.
+EXPORT_WORKERS = int(os.environ.get('SPM_EXPORT_WORKERS', min(4, os.cpu_count() or 1)))
+
+# Export formats: per image (png, txt, itx) and per series (npy, hdf5)
+EXPORT_FORMATS = OrderedDict([
+    ('png', 'png'),
+    ('txt', 'txt'),
+    ('itx', 'IGOR itx'),
+    ('npy', 'npy'),
+    ('hdf5', 'HDF5'),
+])
+IMAGE_EXPORT_FORMATS = ('png', 'txt', 'itx')
+DEFAULT_EXPORT_FORMATS = ('png', 'txt', 'itx')
+
+def series_file_name(series_label):
+    return series_label.lower().replace(" ", '_').replace("=", '').replace('^', '').replace(',', '')
+
+def export_igor_wave(data, extent, plot_name):
+    return igor.Wave2d(
+            data=data,
+            xmin=extent[0],
+            xmax=extent[1],
+            xlabel='x [Angstroms]',
+            ymin=extent[2],
+            ymax=extent[3],
+            ylabel='y [Angstroms]',
+            name="'%s'" % plot_name,
+    )
+
+def render_export_job(job):
+    """
+    Renders the png, txt and itx files of one exported image,
+    the formats not in job['formats'] are None.
+    Doesn't use pyplot, so it can be run in a worker process.
+    Returns (plot_name, png bytes, txt bytes, itx string)
+    """
+    data = job['data']
+    extent = job['extent']
+    plot_name = job['plot_name']
+    formats = job.get('formats', DEFAULT_EXPORT_FORMATS)
+    
+    png, txt, itx = None, None, None
+    
+    if 'png' in formats:
+        fig = Figure(figsize=job['figsize'])
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
+        make_plot(fig, ax, data, center0=job['center0'], vmin=job['vmin'], vmax=job['vmax'],
+                  extent=extent, title=job['title'], cmap=job['cmap'], noadd=False,
+                  data_amax=job.get('data_amax'))
+        imgdata = io.BytesIO()
+        fig.savefig(imgdata, format='png', dpi=PNG_DPI, bbox_inches='tight')
+        png = imgdata.getvalue()
+    
+    if 'txt' in formats:
+        header = "xlim=(%.2f, %.2f), ylim=(%.2f, %.2f)" % (extent[0], extent[1],
+                                                           extent[2], extent[3])
+        txtdata = io.BytesIO()
+        np.savetxt(txtdata, data, header=header, fmt="%.3e")
+        txt = txtdata.getvalue()
+    
+    if 'itx' in formats:
+        itx = str(export_igor_wave(data, extent, plot_name))
+    
+    return plot_name, png, txt, itx
+
 class SeriesPlotter():
     
     def __init__(self, select_indexes_function, zip_prepend):
         
         self.series = {}
+        self.series_stats = {}
+        self.series_pyramids = {}
         
         self.extent = None
+        self.x_arr = None
+        self.y_arr = None
         self.figure_xy_ratio = None
         self.wc_pk = None
         
@@ -129,6 +441,7 @@ class SeriesPlotter():
         self.clear_btn.on_click(self.full_clear)
         
         self.plot_output = ipw.VBox()
+        self.gallery = None
         ### -------------------------------------------
         
         self.fig_y = 4
@@ -137,6 +450,10 @@ class SeriesPlotter():
         ### Creating a zip
         self.zip_btn = ipw.Button(description='Image zip', disabled=True)
         self.zip_btn.on_click(self.create_zip_link)
+        
+        self.zip_cancel_btn = ipw.Button(description='Cancel', disabled=True)
+        self.zip_cancel_btn.on_click(self.cancel_zip)
+        self.zip_export = None
 
         self.zip_progress = ipw.FloatProgress(
                 value=0,
@@ -147,6 +464,18 @@ class SeriesPlotter():
                 orientation='horizontal'
             )
 
+        self.format_checks = OrderedDict(
+            (fmt, ipw.Checkbox(value=fmt in DEFAULT_EXPORT_FORMATS, description=description,
+                               indent=False, layout=ipw.Layout(width='auto')))
+            for fmt, description in EXPORT_FORMATS.items()
+        )
+        if zip_export.h5py is None:
+            self.format_checks['hdf5'].disabled = True
+            self.format_checks['hdf5'].description = 'HDF5 (needs h5py)'
+        self.float32_check = ipw.Checkbox(value=False, description='float32 data',
+                                          indent=False, layout=ipw.Layout(width='auto'))
+        self.zip_options = ipw.HBox(list(self.format_checks.values()) + [self.float32_check])
+
         self.link_out = ipw.Output()
         
 
@@ -160,20 +489,26 @@ class SeriesPlotter():
             series_label = make_series_label(info, i_spin=spin)
             
             self.series[series_label] = (data, info, general_info)
+            self.series_stats[series_label] = SeriesStats(data)
+            self.series_pyramids[series_label] = SeriesPyramid(data)
             
             if info['type'] == 'const-height orbital':
                 sq_info = copy.deepcopy(info)
                 sq_info['type'] = 'const-height orbital^2'
-                sq_data = copy.deepcopy(data) ** 2
+                sq_data = LazySeries(np.square, data)
                 
                 series_label = make_series_label(sq_info, i_spin=spin)
                 self.series[series_label] = (sq_data, sq_info, general_info)
+                self.series_stats[series_label] = SeriesStats(sq_data)
+                self.series_pyramids[series_label] = SeriesPyramid(sq_data)
                 
                 
             
         x_arr = general_info['x_arr'] * 0.529177
         y_arr = general_info['y_arr'] * 0.529177
         
+        self.x_arr = x_arr
+        self.y_arr = y_arr
         self.extent = [np.min(x_arr), np.max(x_arr), np.min(y_arr), np.max(y_arr)]
         self.figure_xy_ratio = (np.max(x_arr)-np.min(x_arr)) / (np.max(y_arr)-np.min(y_arr))
         
@@ -225,190 +560,375 @@ class SeriesPlotter():
         del self.elem_list[rm_index]
         self.selections_vbox.children = remove_from_tuple(self.selections_vbox.children, rm_index)
     
-    def plot_series(self, b):
+    def _new_gallery_cell(self, num_series):
+        """
+        One gallery cell: a figure per series, each rendered into an image widget.
+        The figures, axes and images are kept and updated in place on re-plotting.
+        """
+        rows = []
+        for i_ser in range(num_series):
+            fig = Figure(figsize=(self.fig_y*self.figure_xy_ratio, self.fig_y))
+            FigureCanvasAgg(fig)
+            rows.append({
+                'fig': fig,
+                'ax': fig.add_subplot(1, 1, 1),
+                'image': None,
+                'widget': ipw.Image(format='png'),
+                'key': None,
+            })
+        return {
+            'rows': rows,
+            'widget': ipw.VBox([row['widget'] for row in rows]),
+        }
+    
+    def gallery_pixels(self):
+        """ (x, y) size of a gallery image on screen in pixels """
+        ny_px = 0.8*self.fig_y*matplotlib.rcParams['figure.dpi']
+        return ny_px*self.figure_xy_ratio, ny_px
+    
+    def display_slice(self, series_label, i):
+        """
+        Energy slice i of the series at the pyramid level that fits the gallery image on screen.
+        The full resolution is only used for the export.
+        """
+        nx_px, ny_px = self.gallery_pixels()
+        level = self.series_pyramids[series_label].level_for(int(nx_px), int(ny_px))
+        return np.asarray(level[i, :, :])
+    
+    def color_limits(self, series_label, i, index_list, sym_check, norm_check):
+        """ (vmin, vmax) of energy i, same as make_plot would pick """
+        stats = self.series_stats[series_label]
+        if sym_check:
+            return -stats.absmax[i], stats.absmax[i]
+        if norm_check:
+            return stats.range_min(index_list), stats.range_max(index_list)
+        return stats.min[i], stats.max[i]
+    
+    def png_key(self, series_label, i, cmap, vmin, vmax, size):
+        """ Key of a rendered image in the png cache """
+        return (self.wc_pk, series_label, int(i), cmap, float(vmin), float(vmax), size)
+    
+    def _update_gallery_row(self, row, series_label, i, index_list, cmap, sym_check, norm_check):
         
-        fig_y_in_px = 0.8*self.fig_y*matplotlib.rcParams['figure.dpi']
+        vmin, vmax = self.color_limits(series_label, i, index_list, sym_check, norm_check)
+        dpi = matplotlib.rcParams['figure.dpi']
+        key = self.png_key(series_label, i, cmap, vmin, vmax,
+                           ('gallery', self.fig_y*self.figure_xy_ratio, self.fig_y, dpi))
+        if row['key'] == key:
+            return
         
-        num_series = len(self.elem_list)
-
-        box_layout = ipw.Layout(overflow_x='scroll',
-                        border='3px solid black',
-                        width='100%',
-                        height='%dpx' % (fig_y_in_px*num_series + 70),
-                        display='inline-flex',
-                        flex_flow='column wrap',
-                        align_items='flex-start')
+        png = png_cache.get(key)
+        if png is None:
+            
+            title = self.image_labels(series_label, i)[0]
+            
+            # ---------------------------------------------------------
+            # Make the plot or update the existing one
+            
+            display_data = self.display_slice(series_label, i)
+            
+            if row['image'] is None:
+                make_plot(row['fig'], row['ax'], display_data, vmin=vmin, vmax=vmax,
+                          extent=self.extent, title=title, cmap=cmap, noadd=True)
+                row['image'] = row['ax'].images[-1]
+                # the layout is fixed once, so the updates need a single draw
+                row['fig'].tight_layout()
+            else:
+                row['image'].set_data(display_data.T)
+                row['image'].set_extent(self.extent)
+                row['image'].set_cmap(cmap)
+                row['image'].set_clim(vmin, vmax)
+                row['ax'].set_title(title, loc='left')
+            
+            # straight to the Agg canvas, savefig would draw the figure twice to redo the layout
+            imgdata = io.BytesIO()
+            row['fig'].canvas.print_png(imgdata, pil_kwargs=GALLERY_PNG_OPTIONS)
+            png = imgdata.getvalue()
+            png_cache.put(key, png)
+        
+        row['widget'].value = png
+        row['key'] = key
+    
+    def _update_gallery_cell(self, cell, i, index_list, selections):
+        for row, (series_label, cmap, sym_check, norm_check) in zip(cell['rows'], selections):
+            self._update_gallery_row(row, series_label, i, index_list, cmap, sym_check, norm_check)
+    
+    def plot_series(self, b):
         
-        plot_hbox = ipw.Box(layout=box_layout)
-        self.plot_output.children += (plot_hbox, )
-
-        plot_hbox.children = ()
+        num_series = len(self.elem_list)
         
         index_list = self.select_indexes_function()
-    
-        for i in index_list:
-            plot_out = ipw.Output()
-            plot_hbox.children += (plot_out, )
-            with plot_out:
-                
-                fig = plt.figure(figsize=(self.fig_y*self.figure_xy_ratio, self.fig_y*num_series))
-
-                for i_ser in range(num_series):
-
-                    series_label = self.elem_list[i_ser][0].value
-                    cmap = self.elem_list[i_ser][1].value
-                    sym_check = self.elem_list[i_ser][2].value
-                    norm_check = self.elem_list[i_ser][3].value
-                    
-                    # ---------------------------------------------------------
-                    # Retrieve the series data
-                    
-                    data, info, general_info = self.series[series_label]
-                    
-                    energy = general_info['energies'][i]
-                    
-                    # Build labels, title and file name
-                    orb_indexes = general_info.get('orb_indexes')
-                    homo = general_info.get('homo')
-                    
-                    mo_label = None
-                    if orb_indexes is not None:
-                        mo_label =  make_orb_label(orb_indexes[i], homo)
-                        
-                    title = '%s\n' % series_label
-                    if mo_label is not None:
-                        title += mo_label + ' '
-                    title += 'E=%.2f eV' % energy
-                    
-                    # ---------------------------------------------------------
-                    # Is normalization enabled ?
-                    
-                    vmin = None
-                    vmax = None
-                    if norm_check:
-                        vmin = np.min(data[index_list, :, :])
-                        vmax = np.max(data[index_list, :, :])
-                        
-                    # ---------------------------------------------------------
-                    # Make the plot
-                    
-                    ax = plt.subplot(num_series, 1, i_ser+1)
-
-                    make_plot(fig, ax, data[i, :, :], center0=sym_check, vmin=vmin, vmax=vmax,
-                              extent=self.extent, title=title, cmap=cmap, noadd=True)
-                    
-                    
-                plt.show()
+        selections = self.selected_series()
+        
+        # A new gallery is only needed when the number of rows changes,
+        # otherwise the figures of the last one are updated in place
+        if self.gallery is None or self.gallery['num_series'] != num_series:
+            
+            fig_y_in_px = self.gallery_pixels()[1]
+            
+            box_layout = ipw.Layout(overflow_x='scroll',
+                            border='3px solid black',
+                            width='100%',
+                            height='%dpx' % (fig_y_in_px*num_series + 70),
+                            display='inline-flex',
+                            flex_flow='column wrap',
+                            align_items='flex-start')
+            
+            plot_hbox = ipw.Box(layout=box_layout)
+            self.plot_output.children += (plot_hbox, )
+            
+            self.gallery = {'box': plot_hbox, 'num_series': num_series, 'cells': []}
+        
+        cells = self.gallery['cells']
+        while len(cells) < len(index_list):
+            cells.append(self._new_gallery_cell(num_series))
+        del cells[len(index_list):]
+        
+        for cell, i in zip(cells, index_list):
+            self._update_gallery_cell(cell, i, index_list, selections)
+        
+        self.gallery['box'].children = tuple(cell['widget'] for cell in cells)
                 
     def create_zip_link(self, b):
         
         self.zip_btn.disabled = True
+        self.zip_cancel_btn.disabled = False
         
         filename = "%s_pk%d.zip" % (self.zip_prepend, self.wc_pk)
+        
+        # the selection is fixed when the export starts
+        index_list = self.select_indexes_function()
+        selections = self.selected_series()
+        formats = [fmt for fmt, check in self.format_checks.items() if check.value and not check.disabled]
+        float32 = self.float32_check.value
+        
+        def write_content(zip_file, export):
+            self.data_to_zip(zip_file, index_list=index_list, selections=selections, export=export,
+                             formats=formats, float32=float32)
+        
+        def on_done(export):
+            self.zip_cancel_btn.disabled = True
+            with self.link_out:
+                if export.status == 'done':
+                    display(HTML('<a href="tmp/%s" target="_blank">download zip</a>' % filename))
+                elif export.status == 'failed':
+                    print("Export failed: %s" % export.error)
+            if export.status != 'done':
+                self.zip_progress.value = 0.0
+                self.zip_btn.disabled = False
+        
+        self.zip_export = zip_export.ZipExport('tmp/'+filename, write_content, on_done=on_done).start()
+        
+    def cancel_zip(self, b):
+        if self.zip_export is not None:
+            self.zip_export.cancel()
+        
+    def selected_series(self):
+        """ [(series_label, cmap, sym_check, norm_check), ...] of the selection rows """
+        return [tuple(elem.value for elem in row[:4]) for row in self.elem_list]
+        
+    def export_jobs(self, index_list, selections, formats=DEFAULT_EXPORT_FORMATS):
+        """
+        Yields the render jobs of all selected (energy, series) images in the zip order
+        """
+        for i in index_list:
+            for series_label, cmap, sym_check, norm_check in selections:
+                yield self.image_job(series_label, i, index_list, cmap, sym_check, norm_check, formats)
+    
+    def image_labels(self, series_label, i):
+        """ (title, plot_name) of energy i of a series """
+        
+        data, info, general_info = self.series[series_label]
 
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
-            self.data_to_zip(zip_file)
+        energy = general_info['energies'][i]
 
-        os.makedirs("tmp", exist_ok=True)
+        # Build labels, title and file name
+        orb_indexes = general_info.get('orb_indexes')
+        homo = general_info.get('homo')
 
-        with open('tmp/'+filename, 'wb') as f:
-            f.write(zip_buffer.getvalue())
+        mo_label = None
+        if orb_indexes is not None:
+            mo_label =  make_orb_label(orb_indexes[i], homo)
 
-        with self.link_out:
-            display(HTML('<a href="tmp/%s" target="_blank">download zip</a>' % filename))
+        title = '%s\n' % series_label
+        if mo_label is not None:
+            title += mo_label + ' '
+        title += 'E=%.2f eV' % energy
         
-    def data_to_zip(self, zip_file):
+        plot_name = series_file_name(series_label)
+        if mo_label is not None:
+            plot_name += "_mo%03d_e%.2f" % (orb_indexes[i], energy)
+        else:
+            plot_name += "_%03d_e%.2f" % (i, energy)
         
-        index_list = self.select_indexes_function()
-        
-        num_series = len(self.elem_list)
+        return title, plot_name
+    
+    def image_job(self, series_label, i, index_list, cmap, sym_check, norm_check,
+                  formats=DEFAULT_EXPORT_FORMATS):
+        """ Export render job (see render_export_job) of energy i of a series """
         
-        total_pics = len(index_list) * num_series
+        data, info, general_info = self.series[series_label]
+        stats = self.series_stats[series_label]
         
-        for i in index_list:
-            for i_ser in range(num_series):
-                
-                series_label = self.elem_list[i_ser][0].value
-                cmap = self.elem_list[i_ser][1].value
-                sym_check = self.elem_list[i_ser][2].value
-                norm_check = self.elem_list[i_ser][3].value
-                
-                # ---------------------------------------------------------
-                # Retrieve the series data
-
-                data, info, general_info = self.series[series_label]
-
-                energy = general_info['energies'][i]
-
-                # Build labels, title and file name
-                orb_indexes = general_info.get('orb_indexes')
-                homo = general_info.get('homo')
-
-                mo_label = None
-                if orb_indexes is not None:
-                    mo_label =  make_orb_label(orb_indexes[i], homo)
-
-                title = '%s\n' % series_label
-                if mo_label is not None:
-                    title += mo_label + ' '
-                title += 'E=%.2f eV' % energy
-                
-                plot_name = series_label.lower().replace(" ", '_').replace("=", '').replace('^', '').replace(',', '')
-                if mo_label is not None:
-                    plot_name += "_mo%03d_e%.2f" % (orb_indexes[i], energy)
-                else:
-                    plot_name += "_%03d_e%.2f" % (i, energy)
-                    
-                # ---------------------------------------------------------
-                # Is normalization enabled ?
-
-                vmin = None
-                vmax = None
-                if norm_check:
-                    vmin = np.min(data[index_list, :, :])
-                    vmax = np.max(data[index_list, :, :])
-                
-                # ---------------------------------------------------
-                # Add the png to zip
-                
-                fig = plt.figure(figsize=(self.fig_y*self.figure_xy_ratio, self.fig_y))
-                ax = plt.gca()
-
-                make_plot(fig, ax, data[i, :, :], center0=sym_check, vmin=vmin, vmax=vmax,
-                          extent=self.extent, title=title, cmap=cmap, noadd=False)
-                
-                imgdata = io.BytesIO()
-                fig.savefig(imgdata, format='png', dpi=200, bbox_inches='tight')
-                zip_file.writestr(plot_name+".png", imgdata.getvalue())
-                plt.close()
-                
-                # ---------------------------------------------------
-                # Add txt data to the zip
-                header = "xlim=(%.2f, %.2f), ylim=(%.2f, %.2f)" % (self.extent[0], self.extent[1],
-                                                                   self.extent[2], self.extent[3])
-                txtdata = io.BytesIO()
-                np.savetxt(txtdata, data[i, :, :], header=header, fmt="%.3e")
-                zip_file.writestr("txt/"+plot_name+".txt", txtdata.getvalue())
-                # ---------------------------------------------------
-
-                # ---------------------------------------------------
-                # Add IGOR format to zip
-                igorwave = igor.Wave2d(
-                        data=data[i, :, :],
-                        xmin=self.extent[0],
-                        xmax=self.extent[1],
-                        xlabel='x [Angstroms]',
-                        ymin=self.extent[2],
-                        ymax=self.extent[3],
-                        ylabel='y [Angstroms]',
-                        name="'%s'" % plot_name,
-                )
-                zip_file.writestr("itx/"+plot_name+".itx", str(igorwave))
-                # ---------------------------------------------------
-
-                self.zip_progress.value += 1.0/float(total_pics-1)
-                
+        title, plot_name = self.image_labels(series_label, i)
+            
+        # ---------------------------------------------------------
+        # Is normalization enabled ?
+
+        vmin = None
+        vmax = None
+        if norm_check:
+            vmin = stats.range_min(index_list)
+            vmax = stats.range_max(index_list)
+        
+        figsize = (self.fig_y*self.figure_xy_ratio, self.fig_y)
+        png_key = self.png_key(series_label, i, cmap,
+                               *self.color_limits(series_label, i, index_list, sym_check, norm_check),
+                               size=('export', ) + figsize + (PNG_DPI, ))
+        
+        return {
+            'data': np.asarray(data[i, :, :]),
+            'extent': self.extent,
+            'figsize': figsize,
+            'title': title,
+            'plot_name': plot_name,
+            'cmap': cmap,
+            'center0': sym_check,
+            'vmin': vmin,
+            'vmax': vmax,
+            'data_amax': stats.absmax[i],
+            'formats': formats,
+            'png_key': png_key,
+        }
+    
+    def data_to_zip(self, zip_file, index_list=None, selections=None, export=None, workers=EXPORT_WORKERS,
+                    formats=DEFAULT_EXPORT_FORMATS, float32=False):
+        """
+        Renders the selected images on a pool of worker processes and
+        writes the png, txt and itx files to the zip in order.
+        Only a few images are in flight at a time, so memory stays bounded.
+        The npy and hdf5 formats add the raw data of the selected series.
+        """
+        if index_list is None:
+            index_list = self.select_indexes_function()
+        if selections is None:
+            selections = self.selected_series()
+        
+        image_formats = [fmt for fmt in formats if fmt in IMAGE_EXPORT_FORMATS]
+        total_pics = len(index_list) * len(selections) if image_formats else 0
+        
+        self.zip_progress.value = 0.0
+        
+        if total_pics > 0:
+            self._images_to_zip(zip_file, index_list, selections, image_formats, total_pics, export, workers)
+        
+        self.binary_data_to_zip(zip_file, index_list, selections, formats, float32, export)
+        self.zip_progress.value = 1.0
+    
+    def _images_to_zip(self, zip_file, index_list, selections, formats, total_pics, export, workers):
+        
+        # (png key, cached png, igor wave) of the jobs handed out, in order
+        job_pngs = collections.deque()
+        
+        def jobs_without_cached_pngs():
+            for job in self.export_jobs(index_list, selections, formats):
+                png = png_cache.get(job['png_key']) if 'png' in formats else None
+                # the itx text is streamed into the zip here, not built by the worker
+                wave = None
+                if 'itx' in formats:
+                    wave = export_igor_wave(job['data'], job['extent'], job['plot_name'])
+                job_pngs.append((job['png_key'], png, wave))
+                job['formats'] = [fmt for fmt in formats
+                                  if fmt != 'itx' and not (fmt == 'png' and png is not None)]
+                if len(job['formats']) == 0:
+                    # nothing to render, don't send the data to the worker
+                    job['data'] = None
+                yield job
+        
+        jobs = jobs_without_cached_pngs()
+        
+        def write_results(results):
+            for i_pic, (plot_name, png, txt, itx) in enumerate(results):
+                png_key, cached_png, wave = job_pngs.popleft()
+                if cached_png is not None:
+                    png = cached_png
+                elif png is not None:
+                    png_cache.put(png_key, png)
+                if png is not None:
+                    zip_file.writestr(plot_name+".png", png)
+                if txt is not None:
+                    zip_file.writestr("txt/"+plot_name+".txt", txt)
+                if wave is not None:
+                    zip_export.write_text(zip_file, "itx/"+plot_name+".itx", wave.write_to)
+                self.zip_progress.value = (i_pic+1)/float(total_pics)
+                if export is not None:
+                    export.check_cancelled()
+        
+        if workers <= 1 or total_pics <= 1:
+            write_results(map(render_export_job, jobs))
+            return
+        
+        # forkserver, as forking the kernel process from the export thread is not safe
+        mp_context = multiprocessing.get_context('forkserver')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+            write_results(zip_export.ordered_bounded_map(
+                executor, render_export_job, jobs, max_in_flight=2*workers))
+    
+    def binary_data_to_zip(self, zip_file, index_list, selections, formats, float32=False, export=None):
+        """
+        Writes the full [energy, x, y] cube of every selected series as
+        npy/<series>.npy with npy/meta.npz holding the axes,
+        and/or as a single data.h5 with a dataset per series.
+        The selected energy indexes are recorded as index_list.
+        """
+        if 'npy' not in formats and 'hdf5' not in formats:
+            return
+        
+        # a series can be selected in several rows
+        series_labels = list(OrderedDict.fromkeys(sel[0] for sel in selections))
+        
+        meta = {
+            'series_labels': np.array(series_labels),
+            'index_list': np.array(index_list),
+            'x_arr': self.x_arr,
+            'y_arr': self.y_arr,
+            'extent': np.array(self.extent),
+        }
+        
+        series_entries = OrderedDict()
+        for series_label in series_labels:
+            data, info, general_info = self.series[series_label]
+            name = series_file_name(series_label)
+            dtype = np.float32 if float32 else data.dtype
+            shape = tuple(data.shape)
+            energies = np.asarray(general_info['energies'])
+            
+            attrs = {'label': series_label, 'energies': energies}
+            meta[name + '_energies'] = energies
+            orb_indexes = general_info.get('orb_indexes')
+            if orb_indexes is not None:
+                attrs['orb_indexes'] = np.asarray(orb_indexes)
+                meta[name + '_orb_indexes'] = attrs['orb_indexes']
+            
+            series_entries[name] = (data, shape, dtype, attrs)
+        
+        if 'npy' in formats:
+            for name, (data, shape, dtype, attrs) in series_entries.items():
+                zip_export.write_npy(zip_file, "npy/%s.npy" % name,
+                                     (data[i, :, :] for i in range(shape[0])), shape, dtype, export)
+            meta_data = io.BytesIO()
+            np.savez(meta_data, **meta)
+            zip_file.writestr("npy/meta.npz", meta_data.getvalue())
+        
+        if 'hdf5' in formats:
+            datasets = OrderedDict([('x_arr', self.x_arr), ('y_arr', self.y_arr)])
+            for name, (data, shape, dtype, attrs) in series_entries.items():
+                datasets[name] = ((data[i, :, :] for i in range(shape[0])), shape, dtype, attrs)
+            zip_export.write_hdf5(zip_file, "data.h5", datasets,
+                                  attrs={'extent': np.array(self.extent), 'units': 'Angstrom, eV',
+                                         'index_list': np.array(index_list)},
+                                  export=export)
                 
     def full_clear(self, b):
         self.plot_output.children = ()
+        self.gallery = None
@@ -88,7 +88,7 @@ class STMWorkChain(WorkChain):
         } 
         
         # Need to make an explicit instance for the node to be stored to aiida
-        settings = Dict(dict={'additional_retrieve_list': ['stm.npz']})
+        settings = common.get_or_store_node(Dict(dict={'additional_retrieve_list': ['stm.npz']}))
         inputs['settings'] = settings
         
         self.report("Inputs: " + str(inputs))
@@ -0,0 +1,159 @@
+"""Streaming zip export for the viewer downloads
+
+The archive is written entry by entry directly to disk on a background
+thread, so the kernel stays responsive and a running export can be cancelled.
+"""
+
+import io
+import os
+import zipfile
+import tempfile
+import threading
+import collections
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+class ExportCancelled(Exception):
+    pass
+
+class ZipExport(object):
+    """
+    Writes the zip archive 'path' on a background thread.
+
+    write_content(zip_file, export) adds the entries to the open zip file and
+    should call export.check_cancelled() between the entries.
+    on_done(export) is called from the background thread when finished,
+    export.status is then 'done', 'cancelled' or 'failed' (see export.error).
+    """
+
+    def __init__(self, path, write_content, on_done=None):
+        self.path = path
+        self.write_content = write_content
+        self.on_done = on_done
+
+        self.status = 'created'
+        self.error = None
+
+        self._cancel_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def start(self):
+        self.status = 'running'
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise ExportCancelled()
+
+    def _run(self):
+        # write to a partial file first, so an unfinished archive is never linked
+        part_path = self.path + '.part'
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with zipfile.ZipFile(part_path, "w", zipfile.ZIP_DEFLATED, False) as zip_file:
+                self.write_content(zip_file, self)
+            self.check_cancelled()
+            os.replace(part_path, self.path)
+            self.status = 'done'
+        except ExportCancelled:
+            self.status = 'cancelled'
+        except Exception as e:
+            self.status = 'failed'
+            self.error = e
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+        if self.on_done is not None:
+            self.on_done(self)
+
+def ordered_bounded_map(executor, fn, iterable, max_in_flight):
+    """
+    Like executor.map, but at most max_in_flight jobs are submitted at a time,
+    so only a few inputs and results are held in memory. Results are yielded in order.
+    """
+    futures = collections.deque()
+    for item in iterable:
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+        futures.append(executor.submit(fn, item))
+    while futures:
+        yield futures.popleft().result()
+
+def write_npy(zip_file, name, slices, shape, dtype, export=None):
+    """
+    Streams an .npy file of the given shape into the zip,
+    one slice along the first axis at a time
+    """
+    dtype = np.dtype(dtype)
+    header = {
+        'descr': np.lib.format.dtype_to_descr(dtype),
+        'fortran_order': False,
+        'shape': tuple(shape),
+    }
+    with zip_file.open(name, 'w', force_zip64=True) as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        for data_slice in slices:
+            if export is not None:
+                export.check_cancelled()
+            f.write(np.ascontiguousarray(data_slice, dtype=dtype).tobytes())
+
+def write_text(zip_file, name, write_to):
+    """
+    Streams a text file into the zip, write_to(f) writes it to the text file object f
+    (e.g. igor.Wave.write_to), so the whole text is never held in memory
+    """
+    with io.TextIOWrapper(zip_file.open(name, 'w', force_zip64=True), encoding='utf-8', newline='') as f:
+        write_to(f)
+
+def write_hdf5(zip_file, name, datasets, attrs=None, export=None):
+    """
+    Adds an HDF5 file to the zip (needs h5py).
+
+    datasets: {dataset name: array} or {dataset name: (slices, shape, dtype, attrs)},
+    the latter is filled one slice along the first axis at a time.
+    The file is built in a temporary file, as HDF5 can't be streamed.
+    """
+    if h5py is None:
+        raise ImportError("HDF5 export needs the h5py package")
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        with h5py.File(tmp_path, 'w') as h5_file:
+            for key, value in (attrs or {}).items():
+                h5_file.attrs[key] = value
+            for ds_name, ds_data in datasets.items():
+                if isinstance(ds_data, np.ndarray):
+                    h5_file.create_dataset(ds_name, data=ds_data)
+                    continue
+                slices, shape, dtype, ds_attrs = ds_data
+                dataset = h5_file.create_dataset(ds_name, shape=tuple(shape), dtype=dtype)
+                for i_slice, data_slice in enumerate(slices):
+                    if export is not None:
+                        export.check_cancelled()
+                    dataset[i_slice] = data_slice
+                for key, value in ds_attrs.items():
+                    dataset.attrs[key] = value
+        zip_file.write(tmp_path, arcname=name)
+    finally:
+        os.remove(tmp_path)